@@ -1,15 +1,27 @@
-from fastapi import FastAPI, HTTPException, Depends
+from fastapi import FastAPI, HTTPException, Depends, Request, Query
 from fastapi.middleware.cors import CORSMiddleware
-from fastapi.responses import JSONResponse
-from pydantic import BaseModel, Field
-from typing import List, Union, Dict, Any, Optional
+from fastapi.responses import JSONResponse, StreamingResponse
+from pydantic import BaseModel, Field, ValidationError
+from typing import List, Union, Dict, Any, Optional, AsyncIterator, Tuple, Callable, Awaitable, Literal, Set
 import anthropic
+import httpx
 import os
 import json
 import uuid
+import hashlib
+import time
+import asyncio
+import math
+import random
 from datetime import datetime
 import logging
+import sqlite3
+import threading
+import csv
+import zlib
 from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from collections import OrderedDict, deque
 
 # Configure logging
 logging.basicConfig(level=logging.INFO)
@@ -18,6 +30,101 @@ logger = logging.getLogger(__name__)
 # Initialize Anthropic client
 anthropic_client = None
 
+# Shared HTTP connection pool for upstream Claude calls
+ANTHROPIC_MAX_CONNECTIONS = int(os.getenv("ANTHROPIC_MAX_CONNECTIONS", "200"))
+ANTHROPIC_MAX_KEEPALIVE = int(os.getenv("ANTHROPIC_MAX_KEEPALIVE", "50"))
+ANTHROPIC_TIMEOUT = float(os.getenv("ANTHROPIC_TIMEOUT", "120"))
+
+# Process-wide limit on concurrent upstream Claude calls and on calls waiting for a slot
+UPSTREAM_CONCURRENCY = int(os.getenv("UPSTREAM_CONCURRENCY", "50"))
+UPSTREAM_QUEUE_SIZE = int(os.getenv("UPSTREAM_QUEUE_SIZE", "200"))
+
+# Adapt the upstream concurrency limit (up to UPSTREAM_CONCURRENCY) to observed latency (AIMD)
+ADAPTIVE_CONCURRENCY = os.getenv("ADAPTIVE_CONCURRENCY", "true").lower() == "true"
+ADAPTIVE_INITIAL_CONCURRENCY = int(os.getenv("ADAPTIVE_INITIAL_CONCURRENCY", "10"))
+ADAPTIVE_LATENCY_TOLERANCE = float(os.getenv("ADAPTIVE_LATENCY_TOLERANCE", "2.0"))
+ADAPTIVE_BACKOFF = float(os.getenv("ADAPTIVE_BACKOFF", "0.5"))
+
+# Fraction of the Anthropic rate limits kept in reserve when pacing upstream calls
+RATE_LIMIT_HEADROOM = float(os.getenv("RATE_LIMIT_HEADROOM", "0.05"))
+
+# Retries of overloaded, rate-limited, 5xx and timed-out upstream calls: attempts per call,
+# retries shared by all calls of a plan, and the exponential backoff range (full jitter)
+UPSTREAM_MAX_ATTEMPTS = int(os.getenv("UPSTREAM_MAX_ATTEMPTS", "4"))
+PLAN_RETRY_BUDGET = int(os.getenv("PLAN_RETRY_BUDGET", "9"))
+RETRY_BASE_DELAY = float(os.getenv("RETRY_BASE_DELAY", "1.0"))
+RETRY_MAX_DELAY = float(os.getenv("RETRY_MAX_DELAY", "30.0"))
+
+# Model tiers squares are routed to (see SQUARE_ROUTES), and the failed attempts on a square's
+# primary model after which its retries go to the fallback model instead
+STANDARD_MODEL = os.getenv("STANDARD_MODEL", "claude-3-5-sonnet-20241022")
+FAST_MODEL = os.getenv("FAST_MODEL", "claude-3-5-haiku-20241022")
+MODEL_FALLBACK_AFTER = int(os.getenv("MODEL_FALLBACK_AFTER", "1"))
+
+# Maximum number of squares generated concurrently for a single plan
+SQUARE_CONCURRENCY = int(os.getenv("SQUARE_CONCURRENCY", "9"))
+
+# "per-square" makes one Claude call per square; "whole-plan" asks for all nine squares in one call
+GenerationMode = Literal["per-square", "whole-plan"]
+GENERATION_MODE: GenerationMode = os.getenv("GENERATION_MODE", "per-square")
+WHOLE_PLAN_MAX_TOKENS = int(os.getenv("WHOLE_PLAN_MAX_TOKENS", "8000"))
+
+# Whole-plan result cache keyed on the canonical questionnaire fingerprint
+PLAN_CACHE_SIZE = int(os.getenv("PLAN_CACHE_SIZE", "1000"))
+PLAN_CACHE_TTL = float(os.getenv("PLAN_CACHE_TTL", "3600"))
+
+# Per-square content cache keyed on only the answers each square's prompt reads
+SQUARE_CACHE_SIZE = int(os.getenv("SQUARE_CACHE_SIZE", "5000"))
+SQUARE_CACHE_TTL = float(os.getenv("SQUARE_CACHE_TTL", "86400"))
+
+# Persistent on-disk cache of generated squares and plans (disabled when DISK_CACHE_DIR is empty)
+DISK_CACHE_DIR = os.getenv("DISK_CACHE_DIR", "")
+DISK_CACHE_MAX_MB = float(os.getenv("DISK_CACHE_MAX_MB", "500"))
+DISK_CACHE_TTL = float(os.getenv("DISK_CACHE_TTL", str(30 * 24 * 3600)))
+
+# Cache the square system prompt and tool, which are shared by every square call of every plan
+PROMPT_CACHE = os.getenv("PROMPT_CACHE", "true").lower() == "true"
+
+# Have Claude return each square through a forced tool call whose schema mirrors MarketingSquare
+STRUCTURED_OUTPUT = os.getenv("STRUCTURED_OUTPUT", "true").lower() == "true"
+
+# Stream every square and abort its call as soon as the output goes off-schema, retrying
+# until SCHEMA_MAX_ATTEMPTS calls have gone off-schema before settling for the fallback content
+STREAM_VALIDATION = os.getenv("STREAM_VALIDATION", "true").lower() == "true"
+SCHEMA_MAX_ATTEMPTS = int(os.getenv("SCHEMA_MAX_ATTEMPTS", "3"))
+
+# max_tokens of a square call: SQUARE_MAX_TOKENS until MAX_TOKENS_MIN_SAMPLES responses of the
+# square have been seen, then a high percentile of its recent output lengths plus headroom
+SQUARE_MAX_TOKENS = int(os.getenv("SQUARE_MAX_TOKENS", "1000"))
+ADAPTIVE_MAX_TOKENS = os.getenv("ADAPTIVE_MAX_TOKENS", "true").lower() == "true"
+MAX_TOKENS_PERCENTILE = float(os.getenv("MAX_TOKENS_PERCENTILE", "0.95"))
+MAX_TOKENS_HEADROOM = float(os.getenv("MAX_TOKENS_HEADROOM", "1.25"))
+MAX_TOKENS_MIN_SAMPLES = int(os.getenv("MAX_TOKENS_MIN_SAMPLES", "20"))
+MAX_TOKENS_FLOOR = int(os.getenv("MAX_TOKENS_FLOOR", "256"))
+MAX_TOKENS_CEILING = int(os.getenv("MAX_TOKENS_CEILING", "4096"))
+
+# Continuation calls made to finish a square response cut off at max_tokens
+MAX_CONTINUATIONS = int(os.getenv("MAX_CONTINUATIONS", "2"))
+
+# Hedged square requests: a duplicate request is sent when a square runs longer than the
+# HEDGE_PERCENTILE of its recent latencies, adding at most HEDGE_BUDGET extra requests per request
+HEDGE_REQUESTS = os.getenv("HEDGE_REQUESTS", "false").lower() == "true"
+HEDGE_PERCENTILE = float(os.getenv("HEDGE_PERCENTILE", "0.95"))
+HEDGE_BUDGET = float(os.getenv("HEDGE_BUDGET", "0.1"))
+HEDGE_MIN_SAMPLES = int(os.getenv("HEDGE_MIN_SAMPLES", "20"))
+
+# Background plan generation jobs: worker count, queued job limit and how long finished jobs are kept
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "1000"))
+JOB_TTL = float(os.getenv("JOB_TTL", "3600"))
+
+# Plans generated at once by a bulk upload
+BULK_CONCURRENCY = int(os.getenv("BULK_CONCURRENCY", "4"))
+
+# Message Batches bulk mode: seconds between batch status polls and requests per submitted batch
+BATCH_POLL_INTERVAL = float(os.getenv("BATCH_POLL_INTERVAL", "60"))
+BATCH_MAX_REQUESTS = int(os.getenv("BATCH_MAX_REQUESTS", "10000"))
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
@@ -27,11 +134,26 @@ async def lifespan(app: FastAPI):
         logger.error("ANTHROPIC_API_KEY environment variable not set")
         raise ValueError("ANTHROPIC_API_KEY environment variable is required")
     
-    anthropic_client = anthropic.Anthropic(api_key=api_key)
-    logger.info("Anthropic client initialized successfully")
+    http_client = anthropic.DefaultAsyncHttpxClient(
+        limits=httpx.Limits(
+            max_connections=ANTHROPIC_MAX_CONNECTIONS,
+            max_keepalive_connections=ANTHROPIC_MAX_KEEPALIVE
+        ),
+        timeout=ANTHROPIC_TIMEOUT
+    )
+    # create_message_with_retry is the only retry layer; SDK retries would multiply attempts
+    # and bypass the retry budget
+    anthropic_client = anthropic.AsyncAnthropic(api_key=api_key, http_client=http_client, max_retries=0)
+    logger.info(f"Anthropic client initialized successfully (max_connections={ANTHROPIC_MAX_CONNECTIONS})")
+    workers = [asyncio.create_task(job_worker()) for _ in range(JOB_WORKERS)]
     yield
     # Shutdown
     logger.info("Application shutting down")
+    for worker in workers:
+        worker.cancel()
+    await anthropic_client.close()
+    if disk_cache is not None:
+        disk_cache.close()
 
 # Initialize FastAPI app
 app = FastAPI(
@@ -65,6 +187,11 @@ class QuestionnaireResponse(BaseModel):
 
 class GeneratePlanRequest(BaseModel):
     responses: List[QuestionnaireResponse]
+    maxConcurrency: Optional[int] = Field(default=None, ge=1, le=9)
+    generationMode: Optional[GenerationMode] = None
+    bypassCache: bool = False
+    # Return and store the squares that succeeded instead of failing the whole plan
+    allowPartial: bool = False
 
 class BusinessContext(BaseModel):
     industry: str
@@ -78,11 +205,38 @@ class MarketingSquare(BaseModel):
     keyPoints: List[str]
     recommendations: List[str]
 
+class PlanUsage(BaseModel):
+    requests: int = 0
+    inputTokens: int = 0
+    outputTokens: int = 0
+    cacheCreationInputTokens: int = 0
+    cacheReadInputTokens: int = 0
+
+    def add(self, other: "PlanUsage"):
+        self.requests += other.requests
+        self.inputTokens += other.inputTokens
+        self.outputTokens += other.outputTokens
+        self.cacheCreationInputTokens += other.cacheCreationInputTokens
+        self.cacheReadInputTokens += other.cacheReadInputTokens
+
+# complete: generated by Claude; fallback: Claude's response could not be parsed and
+# generic content was used; failed: no content, the square is missing from the plan
+SquareStatus = Literal["complete", "fallback", "failed"]
+
 class MarketingPlan(BaseModel):
     businessContext: BusinessContext
     squares: Dict[int, MarketingSquare]
     generatedAt: str
     planId: str
+    usage: Optional[PlanUsage] = None
+    squareStatus: Dict[int, SquareStatus] = {}
+    # The questionnaire the plan was generated from, needed to fill in squares later
+    responses: Optional[List[QuestionnaireResponse]] = None
+
+class UpdatePlanRequest(BaseModel):
+    responses: List[QuestionnaireResponse]
+    maxConcurrency: Optional[int] = Field(default=None, ge=1, le=9)
+    allowPartial: bool = False
 
 class SavePlanRequest(BaseModel):
     plan: MarketingPlan
@@ -94,8 +248,578 @@ class PlanSummary(BaseModel):
     createdAt: str
     businessContext: BusinessContext
 
+JobStatus = Literal["queued", "running", "done", "failed"]
+SquareProgress = Literal["pending", "complete", "fallback", "failed"]
+
+class Job(BaseModel):
+    jobId: str
+    status: JobStatus = "queued"
+    createdAt: str
+    startedAt: Optional[str] = None
+    finishedAt: Optional[str] = None
+    squares: Dict[int, SquareProgress]
+    planId: Optional[str] = None
+    cached: bool = False
+    error: Optional[str] = None
+
+class BatchPlanRequest(BaseModel):
+    questionnaires: List[List[QuestionnaireResponse]]
+    bypassCache: bool = False
+
+class BatchJob(BaseModel):
+    batchJobId: str
+    status: JobStatus = "queued"
+    createdAt: str
+    finishedAt: Optional[str] = None
+    plans: int
+    # Message Batches submitted for this job and their combined request counts
+    anthropicBatchIds: List[str] = []
+    requestCounts: Dict[str, int] = {}
+    # Generated plans, in the order of the submitted questionnaires
+    planIds: List[str] = []
+    error: Optional[str] = None
+
 # In-memory storage (replace with database in production)
 plans_storage: Dict[str, MarketingPlan] = {}
+jobs: Dict[str, Job] = {}
+batch_jobs: Dict[str, BatchJob] = {}
+# Running batch job tasks, referenced so they are not garbage collected
+batch_tasks: set = set()
+# Jobs waiting for a worker, with the request and client to run them with
+job_queue: "asyncio.Queue[Tuple[Job, GeneratePlanRequest, anthropic.AsyncAnthropic]]" = asyncio.Queue(JOB_QUEUE_SIZE)
+
+class LRUCache:
+    """In-process LRU cache with a TTL and hit/miss counters"""
+
+    def __init__(self, max_size: int, ttl: float):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.entries: "OrderedDict[str, Tuple[float, Any]]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: str) -> Optional[Any]:
+        entry = self.entries.get(key)
+        if entry is None or time.monotonic() - entry[0] > self.ttl:
+            self.entries.pop(key, None)
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        self.hits += 1
+        return entry[1]
+
+    def put(self, key: str, value: Any):
+        self.entries[key] = (time.monotonic(), value)
+        self.entries.move_to_end(key)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+
+    def stats(self) -> Dict[str, Any]:
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hitRate": self.hits / lookups if lookups else 0.0,
+            "size": len(self.entries),
+            "maxSize": self.max_size,
+            "ttlSeconds": self.ttl
+        }
+
+class DiskCache:
+    """SQLite-backed cache (WAL mode) that survives restarts.
+
+    The database is opened lazily on first use and entries are only read on demand.
+    When the stored payloads exceed max_bytes the least recently used entries are evicted.
+    """
+
+    def __init__(self, directory: str, max_bytes: int, ttl: float):
+        self.path = os.path.join(directory, "cache.sqlite3")
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.connection: Optional[sqlite3.Connection] = None
+        self.lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def _connect(self) -> sqlite3.Connection:
+        if self.connection is None:
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, check_same_thread=False)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS entries ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, "
+                "created_at REAL NOT NULL, accessed_at REAL NOT NULL)"
+            )
+            connection.execute("CREATE INDEX IF NOT EXISTS entries_accessed_at ON entries (accessed_at)")
+            self.total_bytes = connection.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+            self.connection = connection
+            logger.info(f"Disk cache opened at {self.path} ({self.total_bytes} bytes)")
+        return self.connection
+
+    def _get(self, key: str) -> Optional[Any]:
+        with self.lock:
+            connection = self._connect()
+            row = connection.execute("SELECT value, created_at FROM entries WHERE key = ?", (key,)).fetchone()
+            if row is None or time.time() - row[1] > self.ttl:
+                self.misses += 1
+                return None
+            connection.execute("UPDATE entries SET accessed_at = ? WHERE key = ?", (time.time(), key))
+            connection.commit()
+            self.hits += 1
+            return json.loads(row[0])
+
+    def _put(self, key: str, value: Any):
+        payload = json.dumps(value)
+        now = time.time()
+        with self.lock:
+            connection = self._connect()
+            previous = connection.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            connection.execute(
+                "INSERT OR REPLACE INTO entries (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                (key, payload, len(payload), now, now)
+            )
+            self.total_bytes += len(payload) - (previous[0] if previous else 0)
+            while self.total_bytes > self.max_bytes:
+                oldest = connection.execute(
+                    "SELECT key, size FROM entries ORDER BY accessed_at LIMIT 1"
+                ).fetchone()
+                if oldest is None:
+                    break
+                connection.execute("DELETE FROM entries WHERE key = ?", (oldest[0],))
+                self.total_bytes -= oldest[1]
+                self.evictions += 1
+            connection.commit()
+
+    async def get(self, key: str) -> Optional[Any]:
+        return await asyncio.to_thread(self._get, key)
+
+    async def put(self, key: str, value: Any):
+        await asyncio.to_thread(self._put, key, value)
+
+    def close(self):
+        with self.lock:
+            if self.connection is not None:
+                self.connection.close()
+                self.connection = None
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "path": self.path,
+            "open": self.connection is not None,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "bytes": self.total_bytes,
+            "maxBytes": self.max_bytes
+        }
+
+# Generated plans keyed on questionnaire fingerprint
+plan_cache = LRUCache(PLAN_CACHE_SIZE, PLAN_CACHE_TTL)
+
+# Second-level cache behind the in-memory square and plan caches
+disk_cache = DiskCache(DISK_CACHE_DIR, int(DISK_CACHE_MAX_MB * 1024 * 1024), DISK_CACHE_TTL) if DISK_CACHE_DIR else None
+
+class UpstreamOverloadedError(Exception):
+    """Raised when the upstream admission queue is full"""
+
+    def __init__(self, retry_after: int):
+        super().__init__(f"Upstream capacity exhausted, retry after {retry_after}s")
+        self.retry_after = retry_after
+
+# Error types of an error response or of an error event sent part-way through a stream that
+# signal Anthropic is overloaded or rate limiting us. A mid-stream error arrives on an HTTP 200
+# response, so the SDK raises it as a plain APIStatusError
+OVERLOAD_ERROR_TYPES = {"overloaded_error", "rate_limit_error", "api_error"}
+
+def is_overload_error(e: BaseException) -> bool:
+    """Whether an upstream error is transient: overloaded, rate limited, 5xx, timed out or disconnected"""
+    if isinstance(e, (anthropic.RateLimitError, anthropic.InternalServerError, anthropic.APIConnectionError)):
+        return True
+    if not isinstance(e, anthropic.APIStatusError):
+        return False
+    # The sync client (and possibly later async ones) raises HTTP 529 as OverloadedError,
+    # which is not an InternalServerError
+    if e.status_code == 529:
+        return True
+    error = e.body.get("error") if isinstance(e.body, dict) else None
+    return isinstance(error, dict) and error.get("type") in OVERLOAD_ERROR_TYPES
+
+class AdaptiveConcurrencyLimit:
+    """AIMD concurrency limit driven by upstream latency and overload errors.
+
+    Every call that completes at a normal latency raises the limit by 1/limit (about +1
+    per round of calls); a smoothed latency above tolerance x the no-load baseline or an
+    overload error multiplies it by backoff, at most once per smoothed call duration so
+    one spike seen by many in-flight calls is only counted once. Latency (which may be
+    normalised, e.g. per output token) is smoothed with an EWMA so single slow responses
+    do not cut the limit; the baseline is a moving minimum of the smoothed latency that
+    drifts slowly upwards so it can follow a slower model. The cut interval uses the raw
+    wall-clock duration of calls, since only that is comparable with time.
+    """
+
+    def __init__(self, initial: int, minimum: int, maximum: int, tolerance: float = 2.0, backoff: float = 0.5):
+        self.limit = float(min(initial, maximum))
+        self.minimum = minimum
+        self.maximum = maximum
+        self.tolerance = tolerance
+        self.backoff = backoff
+        self.latency: Optional[float] = None
+        self.baseline: Optional[float] = None
+        self.call_seconds: Optional[float] = None
+        self.last_decrease = float("-inf")
+        self.increases = 0
+        self.decreases = 0
+
+    @property
+    def current(self) -> int:
+        return max(self.minimum, int(self.limit))
+
+    def on_sample(
+        self,
+        latency: Optional[float],
+        overloaded: bool = False,
+        now: Optional[float] = None,
+        duration: Optional[float] = None
+    ):
+        """Record one finished call.
+
+        latency is the load signal compared against the baseline; duration is the call's
+        wall-clock seconds (defaults to latency) and paces how often the limit can be cut.
+        """
+        now = time.monotonic() if now is None else now
+        duration = latency if duration is None else duration
+        if duration is not None:
+            self.call_seconds = duration if self.call_seconds is None else 0.8 * self.call_seconds + 0.2 * duration
+        if latency is not None and not overloaded:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.baseline = self.latency if self.baseline is None else min(self.latency, self.baseline * 1.002)
+
+        spike = latency is not None and self.baseline is not None and self.latency > self.baseline * self.tolerance
+        if overloaded or spike:
+            if now - self.last_decrease >= (self.call_seconds or 0.0):
+                self.limit = max(float(self.minimum), self.limit * self.backoff)
+                self.last_decrease = now
+                self.decreases += 1
+        else:
+            self.limit = min(float(self.maximum), self.limit + 1 / self.limit)
+            self.increases += 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "limit": self.current,
+            "latencySeconds": self.latency,
+            "baselineSeconds": self.baseline,
+            "callSeconds": self.call_seconds,
+            "increases": self.increases,
+            "decreases": self.decreases
+        }
+
+class AdmissionController:
+    """Process-wide limit on concurrent upstream calls with a bounded FIFO wait queue.
+
+    Plans reserve their calls up front with admit(); a plan whose calls would not fit in
+    the running slots plus max_queue waiting is shed with UpstreamOverloadedError
+    instead of queueing indefinitely, so admitted plans are never shed halfway through.
+    Each call then waits in slot() until fewer than the current limit are running. With an
+    AdaptiveConcurrencyLimit the limit follows upstream latency, otherwise it is max_concurrent.
+    """
+
+    def __init__(self, max_concurrent: int, max_queue: int, adaptive: Optional[AdaptiveConcurrencyLimit] = None):
+        self.max_concurrent = max_concurrent
+        self.max_queue = max_queue
+        self.adaptive = adaptive
+        self.condition = asyncio.Condition()
+        self.active = 0
+        self.waiting = 0
+        self.reserved = 0
+        self.admitted = 0
+        self.rejected = 0
+        self.queue_times: deque = deque(maxlen=1000)
+        # Moving average of upstream call duration, used to estimate Retry-After
+        self.call_seconds = 10.0
+
+    @property
+    def limit(self) -> int:
+        return self.adaptive.current if self.adaptive is not None else self.max_concurrent
+
+    def retry_after(self, extra_calls: int = 0) -> int:
+        """Seconds until the reserved backlog (plus extra_calls) is expected to drain"""
+        queued = max(0, self.reserved + extra_calls - self.limit)
+        return max(1, math.ceil((queued / self.limit + 1) * self.call_seconds))
+
+    def check_capacity(self, calls: int):
+        """Raise UpstreamOverloadedError if a plan needing this many calls would be shed now"""
+        if self.reserved + calls > self.limit + self.max_queue:
+            self.rejected += 1
+            raise UpstreamOverloadedError(self.retry_after(calls))
+
+    def admit(self, calls: int):
+        """Reserve capacity for a plan's calls; pair with release()"""
+        self.check_capacity(calls)
+        self.reserved += calls
+
+    def release(self, calls: int):
+        self.reserved -= calls
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one upstream slot for a call.
+
+        The caller may set "output_tokens" on the yielded dict so the adaptive limit
+        compares latency per output token rather than raw latency.
+        """
+        # Safety valve for calls made outside an admitted plan. A plan's calls, including its
+        # retries and continuations, always queue: admit() reserved capacity for the plan
+        # against the limit at the time, and shedding part-way would waste the squares done
+        if not current_plan_admitted.get() and self.active >= self.limit and self.waiting >= self.max_queue:
+            self.rejected += 1
+            raise UpstreamOverloadedError(self.retry_after())
+
+        queued_at = time.monotonic()
+        async with self.condition:
+            self.waiting += 1
+            try:
+                await self.condition.wait_for(lambda: self.active < self.limit)
+            finally:
+                self.waiting -= 1
+            self.active += 1
+        started_at = time.monotonic()
+        self.queue_times.append(started_at - queued_at)
+        self.admitted += 1
+        call: Dict[str, Any] = {}
+        overloaded = False
+        try:
+            yield call
+        except anthropic.APIError as e:
+            overloaded = is_overload_error(e)
+            raise
+        finally:
+            elapsed = time.monotonic() - started_at
+            self.call_seconds = 0.8 * self.call_seconds + 0.2 * elapsed
+            output_tokens = call.get("output_tokens")
+            latency = elapsed / max(output_tokens, 100) if output_tokens else None
+            # Calls that failed for other reasons (e.g. aborted streams) say nothing about load
+            if self.adaptive is not None and (latency is not None or overloaded):
+                self.adaptive.on_sample(latency, overloaded, duration=elapsed)
+            async with self.condition:
+                self.active -= 1
+                self.condition.notify_all()
+
+    def stats(self) -> Dict[str, Any]:
+        queue_times = sorted(self.queue_times)
+        def percentile(p: float) -> float:
+            return queue_times[min(len(queue_times) - 1, int(p * len(queue_times)))] * 1000 if queue_times else 0.0
+        return {
+            "maxConcurrent": self.max_concurrent,
+            "limit": self.limit,
+            "adaptive": self.adaptive.stats() if self.adaptive is not None else None,
+            "maxQueue": self.max_queue,
+            "active": self.active,
+            "waiting": self.waiting,
+            "reserved": self.reserved,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queueTimeMs": {
+                "p50": percentile(0.5),
+                "p95": percentile(0.95),
+                "max": queue_times[-1] * 1000 if queue_times else 0.0
+            },
+            "avgCallSeconds": self.call_seconds
+        }
+
+upstream_limiter = AdmissionController(
+    UPSTREAM_CONCURRENCY,
+    UPSTREAM_QUEUE_SIZE,
+    AdaptiveConcurrencyLimit(
+        ADAPTIVE_INITIAL_CONCURRENCY, 1, UPSTREAM_CONCURRENCY, ADAPTIVE_LATENCY_TOLERANCE, ADAPTIVE_BACKOFF
+    ) if ADAPTIVE_CONCURRENCY else None
+)
+
+class TokenBucket:
+    """Token bucket refilling at its per-minute limit, re-synced from rate-limit response headers.
+
+    Until the first headers arrive the limit is unknown and the bucket never blocks.
+    """
+
+    def __init__(self):
+        self.capacity: Optional[float] = None
+        self.tokens = 0.0
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        if self.capacity is not None:
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.capacity / 60)
+        self.updated_at = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until amount tokens are available"""
+        if not self.capacity:
+            return 0.0
+        self._refill()
+        return max(0.0, (min(amount, self.capacity) - self.tokens) * 60 / self.capacity)
+
+    def take(self, amount: float):
+        self._refill()
+        self.tokens -= amount
+
+    def sync(self, limit: float, remaining: float):
+        """Adopt the server's view of the bucket, keeping RATE_LIMIT_HEADROOM in reserve"""
+        headroom = limit * RATE_LIMIT_HEADROOM
+        self.capacity = limit - headroom
+        self.tokens = remaining - headroom
+        self.updated_at = time.monotonic()
+
+class RateLimitScheduler:
+    """Paces upstream calls to stay under the requests and output-tokens per minute limits.
+
+    Each call reserves one request and its max_tokens of output up front; unused output is
+    returned when the response (or an error response, which generated none) arrives, and
+    the anthropic-ratelimit-* headers of every response (including 429s) re-sync both buckets.
+    """
+
+    def __init__(self):
+        self.requests = TokenBucket()
+        self.output_tokens = TokenBucket()
+        self.lock = asyncio.Lock()
+        self.paused_until = 0.0
+        self.paced_calls = 0
+        self.paced_seconds = 0.0
+
+    async def acquire(self, max_tokens: int):
+        # Calls are paced in FIFO order; a waiting call holds the lock so later ones queue behind it
+        async with self.lock:
+            while True:
+                wait = max(
+                    self.paused_until - time.monotonic(),
+                    self.requests.wait_time(1),
+                    self.output_tokens.wait_time(max_tokens)
+                )
+                if wait <= 0:
+                    break
+                self.paced_calls += 1
+                self.paced_seconds += wait
+                await asyncio.sleep(wait)
+            self.requests.take(1)
+            self.output_tokens.take(max_tokens)
+
+    def release(self, max_tokens: int, output_tokens: int):
+        """Return the unused part of an output-token reservation"""
+        self.output_tokens.take(output_tokens - max_tokens)
+
+    def update(self, headers: Any):
+        """Re-sync from anthropic-ratelimit-* and retry-after response headers"""
+        for bucket, name in ((self.requests, "requests"), (self.output_tokens, "output-tokens")):
+            limit = headers.get(f"anthropic-ratelimit-{name}-limit")
+            remaining = headers.get(f"anthropic-ratelimit-{name}-remaining")
+            if limit is not None and remaining is not None:
+                bucket.sync(float(limit), float(remaining))
+        retry_after = headers.get("retry-after")
+        if retry_after is not None:
+            try:
+                self.paused_until = max(self.paused_until, time.monotonic() + float(retry_after))
+            except ValueError:
+                pass
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "requestsLimit": self.requests.capacity,
+            "requestsAvailable": self.requests.tokens if self.requests.capacity else None,
+            "outputTokensLimit": self.output_tokens.capacity,
+            "outputTokensAvailable": self.output_tokens.tokens if self.output_tokens.capacity else None,
+            "pacedCalls": self.paced_calls,
+            "pacedSeconds": self.paced_seconds,
+            "pausedFor": max(0.0, self.paused_until - time.monotonic())
+        }
+
+rate_limiter = RateLimitScheduler()
+
+def overloaded_exception(e: UpstreamOverloadedError) -> HTTPException:
+    """503 response telling the client when to retry"""
+    return HTTPException(
+        status_code=503,
+        detail="Marketing plan generation is at capacity, please retry later",
+        headers={"Retry-After": str(e.retry_after)}
+    )
+
+class RetryBudget:
+    """Retries a plan may still spend across all of its upstream calls"""
+
+    def __init__(self, retries: int):
+        self.remaining = retries
+
+    def take(self) -> bool:
+        if self.remaining <= 0:
+            return False
+        self.remaining -= 1
+        return True
+
+retry_stats = {"retries": 0, "recovered": 0, "exhausted": 0, "budgetExhausted": 0, "fallbacks": 0}
+
+class ModelStats:
+    """Upstream calls one route made to one model: outcomes, latency, token usage and cost"""
+
+    def __init__(self):
+        self.calls = 0
+        self.overloaded = 0
+        self.fallbacks = 0
+        self.usage = PlanUsage()
+        self.latencies: deque = deque(maxlen=1000)
+
+    def cost(self, model: str) -> Optional[float]:
+        prices = MODEL_PRICES.get(model)
+        if prices is None:
+            return None
+        input_price, output_price, cache_write_price, cache_read_price = prices
+        return (
+            self.usage.inputTokens * input_price
+            + self.usage.outputTokens * output_price
+            + self.usage.cacheCreationInputTokens * cache_write_price
+            + self.usage.cacheReadInputTokens * cache_read_price
+        ) / 1_000_000
+
+    def stats(self, model: str) -> Dict[str, Any]:
+        latencies = sorted(self.latencies)
+        def percentile(p: float) -> Optional[float]:
+            return latencies[min(len(latencies) - 1, int(p * len(latencies)))] if latencies else None
+        return {
+            "calls": self.calls,
+            "overloaded": self.overloaded,
+            "fallbacks": self.fallbacks,
+            "latencySeconds": {"p50": percentile(0.5), "p95": percentile(0.95)},
+            "usage": self.usage.dict(),
+            "costUsd": self.cost(model)
+        }
+
+# route -> model -> stats; routes are square ids, "wholePlan" and "other"
+route_stats: Dict[str, Dict[str, ModelStats]] = {}
+
+# Plan generations in flight keyed on generation mode, allowPartial and questionnaire fingerprint
+inflight_plans: Dict[str, "asyncio.Task[MarketingPlan]"] = {}
+# Square progress listeners of each in-flight generation and the squares it has completed so far
+inflight_progress: Dict[str, Tuple[List[Callable[[int, Optional[MarketingSquare]], None]], Dict[int, Optional[MarketingSquare]]]] = {}
+single_flight_stats = {"generations": 0, "coalesced": 0, "upstreamCallsSaved": 0}
+
+# Token usage of the plan currently being generated (shared by the tasks it spawns)
+current_plan_usage: ContextVar[Optional[PlanUsage]] = ContextVar("current_plan_usage", default=None)
+# Token usage of the square generated by the current task
+current_square_usage: ContextVar[Optional[PlanUsage]] = ContextVar("current_square_usage", default=None)
+# Models that returned output for the square generated by the current task
+current_square_models: ContextVar[Optional[Set[str]]] = ContextVar("current_square_models", default=None)
+# Retry budget of the plan currently being generated (unlimited outside a plan)
+current_retry_budget: ContextVar[Optional[RetryBudget]] = ContextVar("current_retry_budget", default=None)
+# Whether the current task's upstream calls belong to a plan admitted by upstream_limiter.admit()
+current_plan_admitted: ContextVar[bool] = ContextVar("current_plan_admitted", default=False)
+# Route the current task's upstream calls are accounted to in route_stats
+current_route: ContextVar[str] = ContextVar("current_route", default="other")
+
+def model_stats(model: str) -> ModelStats:
+    """Stats of the current route's calls to a model"""
+    return route_stats.setdefault(current_route.get(), {}).setdefault(model, ModelStats())
 
 # Marketing Squares Configuration
 MARKETING_SQUARES = {
@@ -137,6 +861,150 @@ MARKETING_SQUARES = {
     }
 }
 
+# Questionnaire fields shown in the BUSINESS CONTEXT block of every prompt, as (label, questionId)
+BUSINESS_CONTEXT_FIELDS = [
+    ("Business Industry", "business-industry"),
+    ("Business Model", "business-model"),
+    ("Company Size", "company-size"),
+    ("Geographic Scope", "geographic-scope"),
+    ("Years in Operation", "years-operation"),
+    ("Marketing Budget", "marketing-budget"),
+    ("Primary Challenges", "primary-challenges")
+]
+
+# Square-specific questionnaire fields shown under RELEVANT RESPONSES, as (label, questionId)
+SQUARE_CONTEXT_FIELDS = {
+    1: [  # Target Market
+        ("Target Age", "target-age"),
+        ("Target Income", "target-income"),
+        ("Target Location", "target-location"),
+        ("Customer Pain Points", "customer-pain-points"),
+        ("Customer Goals", "customer-goals"),
+        ("Buying Behavior", "buying-behavior")
+    ],
+    2: [  # Value Proposition
+        ("Unique Selling Points", "unique-selling-points"),
+        ("Key Benefits", "key-benefits"),
+        ("Brand Personality", "brand-personality"),
+        ("Elevator Pitch", "elevator-pitch"),
+        ("Messaging Tone", "messaging-tone")
+    ],
+    3: [  # Media Channels
+        ("Preferred Channels", "preferred-channels"),
+        ("Content Types", "content-types"),
+        ("Content Frequency", "content-frequency"),
+        ("Social Platforms", "social-platforms"),
+        ("Reach Goals", "reach-goals")
+    ],
+    4: [  # Lead Capture
+        ("Lead Magnets", "lead-magnets"),
+        ("Landing Pages", "landing-pages"),
+        ("Conversion Tactics", "conversion-tactics"),
+        ("Lead Goals", "lead-goals")
+    ],
+    5: [  # Lead Nurturing
+        ("Email Sequences", "email-sequences"),
+        ("Nurturing Content", "nurturing-content"),
+        ("Relationship Building", "relationship-building"),
+        ("Nurturing Timeline", "nurturing-timeline")
+    ],
+    6: [  # Sales Conversion
+        ("Sales Process", "sales-process"),
+        ("Common Objections", "common-objections"),
+        ("Closing Techniques", "closing-techniques"),
+        ("Conversion Rate", "conversion-rate")
+    ],
+    7: [  # Customer Experience
+        ("Service Delivery", "service-delivery"),
+        ("Onboarding Process", "onboarding-process"),
+        ("Customer Support", "customer-support"),
+        ("Satisfaction Measurement", "satisfaction-measurement")
+    ],
+    8: [  # Lifetime Value
+        ("Repeat Business", "repeat-business"),
+        ("Upsell Opportunities", "upsell-opportunities"),
+        ("Retention Strategies", "retention-strategies"),
+        ("Lifetime Value", "lifetime-value")
+    ],
+    9: [  # Referral System
+        ("Referral Percentage", "referral-percentage"),
+        ("Referral Process", "referral-process"),
+        ("Referral Incentives", "referral-incentives"),
+        ("Advocacy Opportunities", "advocacy-opportunities"),
+        ("Word of Mouth", "word-of-mouth")
+    ]
+}
+
+def square_dependencies(square_id: int) -> List[str]:
+    """questionIds that the prompt for a square reads"""
+    return [question_id for _, question_id in BUSINESS_CONTEXT_FIELDS + SQUARE_CONTEXT_FIELDS[square_id]]
+
+# questionId -> squares whose prompt reads it; business context fields map to all 9
+QUESTION_DEPENDENTS: Dict[str, List[int]] = {
+    question_id: [square_id for square_id in MARKETING_SQUARES if question_id in square_dependencies(square_id)]
+    for square_id in MARKETING_SQUARES
+    for question_id in square_dependencies(square_id)
+}
+
+# Model routing per square: primary model, request parameters and the model retries fall back to
+# when the primary is overloaded, rate limited or times out. SQUARE_ROUTES overrides entries with
+# JSON, e.g. {"9": {"model": "claude-3-5-haiku-20241022", "fallbackModel": null}}
+SQUARE_ROUTES: Dict[int, Dict[str, Any]] = {
+    square_id: {"model": STANDARD_MODEL, "params": {"temperature": 0.7}, "fallbackModel": FAST_MODEL}
+    for square_id in MARKETING_SQUARES
+}
+for square_id, route in json.loads(os.getenv("SQUARE_ROUTES", "{}")).items():
+    SQUARE_ROUTES[int(square_id)].update(route)
+
+# USD per million tokens as (input, output, cache write, cache read), for route cost metrics
+MODEL_PRICES = {
+    "claude-3-5-sonnet-20241022": (3.0, 15.0, 3.75, 0.3),
+    "claude-3-5-haiku-20241022": (0.8, 4.0, 1.0, 0.08),
+    "claude-3-haiku-20240307": (0.25, 1.25, 0.3, 0.03)
+}
+
+def changed_questions(old: List[QuestionnaireResponse], new: List[QuestionnaireResponse]) -> List[str]:
+    """questionIds answered, unanswered or answered differently in new compared to old"""
+    old_answers = dict(canonicalize_responses(old))
+    new_answers = dict(canonicalize_responses(new))
+    return sorted(
+        question_id for question_id in old_answers.keys() | new_answers.keys()
+        if old_answers.get(question_id) != new_answers.get(question_id)
+    )
+
+def affected_squares(question_ids: List[str]) -> List[int]:
+    """Squares whose prompt reads any of the given questions"""
+    squares = {square_id for question_id in question_ids for square_id in QUESTION_DEPENDENTS.get(question_id, [])}
+    return sorted(squares)
+
+# Per-square caches and the usage their hits have saved
+square_caches: Dict[int, LRUCache] = {
+    square_id: LRUCache(SQUARE_CACHE_SIZE, SQUARE_CACHE_TTL) for square_id in MARKETING_SQUARES
+}
+square_cache_savings: Dict[int, PlanUsage] = {square_id: PlanUsage() for square_id in MARKETING_SQUARES}
+
+def usage_from_response(usage: Any) -> PlanUsage:
+    """Usage of a single Claude response"""
+    return PlanUsage(
+        requests=1,
+        inputTokens=usage.input_tokens or 0,
+        outputTokens=usage.output_tokens or 0,
+        cacheCreationInputTokens=getattr(usage, "cache_creation_input_tokens", None) or 0,
+        cacheReadInputTokens=getattr(usage, "cache_read_input_tokens", None) or 0
+    )
+
+def record_usage(usage: Any, model: str):
+    """Add the usage of a Claude response to the plan and square currently being generated and to its route"""
+    if usage is None:
+        return
+    response_usage = usage_from_response(usage)
+    for tracked in (current_plan_usage.get(), current_square_usage.get(), model_stats(model).usage):
+        if tracked is not None:
+            tracked.add(response_usage)
+    square_models = current_square_models.get()
+    if square_models is not None:
+        square_models.add(model)
+
 def get_anthropic_client():
     """Dependency to get Anthropic client"""
     if anthropic_client is None:
@@ -154,109 +1022,135 @@ def extract_business_context(responses: List[QuestionnaireResponse]) -> Business
         challenges=response_dict.get('primary-challenges', []) if isinstance(response_dict.get('primary-challenges'), list) else []
     )
 
-def create_claude_prompt(responses: List[QuestionnaireResponse], square_id: int) -> str:
-    """Create a detailed prompt for Claude to generate marketing square content"""
-    
-    response_dict = {r.questionId: r.answer for r in responses}
-    square_info = MARKETING_SQUARES[square_id]
-    
-    # Build context from responses
-    business_context = f"""
-Business Industry: {response_dict.get('business-industry', 'Not specified')}
-Business Model: {response_dict.get('business-model', 'Not specified')}
-Company Size: {response_dict.get('company-size', 'Not specified')}
-Geographic Scope: {response_dict.get('geographic-scope', 'Not specified')}
-Years in Operation: {response_dict.get('years-operation', 'Not specified')}
-Marketing Budget: {response_dict.get('marketing-budget', 'Not specified')}
-Primary Challenges: {response_dict.get('primary-challenges', 'Not specified')}
-"""
+def canonicalize_responses(responses: List[QuestionnaireResponse]) -> List[Tuple[str, Any]]:
+    """Normalize responses so equivalent questionnaires compare equal.
 
-    # Square-specific context
-    square_context = ""
-    if square_id == 1:  # Target Market
-        square_context = f"""
-Target Age: {response_dict.get('target-age', 'Not specified')}
-Target Income: {response_dict.get('target-income', 'Not specified')}
-Target Location: {response_dict.get('target-location', 'Not specified')}
-Customer Pain Points: {response_dict.get('customer-pain-points', 'Not specified')}
-Customer Goals: {response_dict.get('customer-goals', 'Not specified')}
-Buying Behavior: {response_dict.get('buying-behavior', 'Not specified')}
-"""
-    elif square_id == 2:  # Value Proposition
-        square_context = f"""
-Unique Selling Points: {response_dict.get('unique-selling-points', 'Not specified')}
-Key Benefits: {response_dict.get('key-benefits', 'Not specified')}
-Brand Personality: {response_dict.get('brand-personality', 'Not specified')}
-Elevator Pitch: {response_dict.get('elevator-pitch', 'Not specified')}
-Messaging Tone: {response_dict.get('messaging-tone', 'Not specified')}
-"""
-    elif square_id == 3:  # Media Channels
-        square_context = f"""
-Preferred Channels: {response_dict.get('preferred-channels', 'Not specified')}
-Content Types: {response_dict.get('content-types', 'Not specified')}
-Content Frequency: {response_dict.get('content-frequency', 'Not specified')}
-Social Platforms: {response_dict.get('social-platforms', 'Not specified')}
-Reach Goals: {response_dict.get('reach-goals', 'Not specified')}
-"""
-    elif square_id == 4:  # Lead Capture
-        square_context = f"""
-Lead Magnets: {response_dict.get('lead-magnets', 'Not specified')}
-Landing Pages: {response_dict.get('landing-pages', 'Not specified')}
-Conversion Tactics: {response_dict.get('conversion-tactics', 'Not specified')}
-Lead Goals: {response_dict.get('lead-goals', 'Not specified')}
-"""
-    elif square_id == 5:  # Lead Nurturing
-        square_context = f"""
-Email Sequences: {response_dict.get('email-sequences', 'Not specified')}
-Nurturing Content: {response_dict.get('nurturing-content', 'Not specified')}
-Relationship Building: {response_dict.get('relationship-building', 'Not specified')}
-Nurturing Timeline: {response_dict.get('nurturing-timeline', 'Not specified')}
-"""
-    elif square_id == 6:  # Sales Conversion
-        square_context = f"""
-Sales Process: {response_dict.get('sales-process', 'Not specified')}
-Common Objections: {response_dict.get('common-objections', 'Not specified')}
-Closing Techniques: {response_dict.get('closing-techniques', 'Not specified')}
-Conversion Rate: {response_dict.get('conversion-rate', 'Not specified')}
-"""
-    elif square_id == 7:  # Customer Experience
-        square_context = f"""
-Service Delivery: {response_dict.get('service-delivery', 'Not specified')}
-Onboarding Process: {response_dict.get('onboarding-process', 'Not specified')}
-Customer Support: {response_dict.get('customer-support', 'Not specified')}
-Satisfaction Measurement: {response_dict.get('satisfaction-measurement', 'Not specified')}
-"""
-    elif square_id == 8:  # Lifetime Value
-        square_context = f"""
-Repeat Business: {response_dict.get('repeat-business', 'Not specified')}
-Upsell Opportunities: {response_dict.get('upsell-opportunities', 'Not specified')}
-Retention Strategies: {response_dict.get('retention-strategies', 'Not specified')}
-Lifetime Value: {response_dict.get('lifetime-value', 'Not specified')}
-"""
-    elif square_id == 9:  # Referral System
-        square_context = f"""
-Referral Percentage: {response_dict.get('referral-percentage', 'Not specified')}
-Referral Process: {response_dict.get('referral-process', 'Not specified')}
-Referral Incentives: {response_dict.get('referral-incentives', 'Not specified')}
-Advocacy Opportunities: {response_dict.get('advocacy-opportunities', 'Not specified')}
-Word of Mouth: {response_dict.get('word-of-mouth', 'Not specified')}
-"""
+    Responses are sorted by questionId, answers are trimmed and list answers sorted.
+    """
+    canonical = {}
+    for r in responses:
+        if isinstance(r.answer, list):
+            answer: Any = sorted(a.strip() for a in r.answer)
+        else:
+            answer = r.answer.strip()
+        canonical[r.questionId.strip()] = answer
+    return sorted(canonical.items())
 
-    prompt = f"""
-You are a senior marketing strategist creating a comprehensive marketing plan. Based on the business information and questionnaire responses provided, generate detailed content for the "{square_info['title']}" section of a 9-square marketing framework.
+def questionnaire_fingerprint(responses: List[QuestionnaireResponse]) -> str:
+    """Stable hash of the canonical questionnaire"""
+    canonical = json.dumps(canonicalize_responses(responses), separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
 
-BUSINESS CONTEXT:
-{business_context}
+def format_fields(response_dict: Dict[str, Any], fields: List[Tuple[str, str]]) -> str:
+    """Render questionnaire fields as 'Label: answer' lines"""
+    return "\n" + "".join(
+        f"{label}: {response_dict.get(question_id, 'Not specified')}\n" for label, question_id in fields
+    )
 
-SQUARE FOCUS: {square_info['title']}
-DESCRIPTION: {square_info['description']}
+def square_fingerprint(responses: List[QuestionnaireResponse], square_id: int) -> str:
+    """Stable hash of the square's primary model and the canonical answers the square depends on"""
+    dependencies = set(square_dependencies(square_id))
+    canonical = [(question_id, answer) for question_id, answer in canonicalize_responses(responses) if question_id in dependencies]
+    model = SQUARE_ROUTES[square_id]["model"]
+    payload = json.dumps([square_id, model, canonical], separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
 
-RELEVANT RESPONSES:
-{square_context}
+async def get_cached_square(responses: List[QuestionnaireResponse], square_id: int) -> Optional[MarketingSquare]:
+    """Look up a square in the per-square cache (then on disk), recording the usage a hit saves"""
+    fingerprint = square_fingerprint(responses, square_id)
+    entry = square_caches[square_id].get(fingerprint)
+    if entry is None and disk_cache is not None:
+        stored = await disk_cache.get(f"square:{fingerprint}")
+        if stored is not None:
+            entry = (MarketingSquare(**stored["square"]), PlanUsage(**stored["usage"]))
+            square_caches[square_id].put(fingerprint, entry)
+    if entry is None:
+        return None
+    square, usage = entry
+    square_cache_savings[square_id].add(usage)
+    return square
+
+async def cache_square(
+    responses: List[QuestionnaireResponse],
+    square_id: int,
+    square: MarketingSquare,
+    usage: PlanUsage,
+    models: Set[str]
+):
+    """Store a generated square, unless it is the generic fallback content.
+
+    Squares that a fallback model wrote any of (models holds every model that returned
+    output for it) are not stored either, so a brief outage of the primary does not pin
+    fallback-model content in the caches for their whole TTL.
+    """
+    if square == fallback_square(square_id):
+        return
+    if models - {SQUARE_ROUTES[square_id]["model"]}:
+        logger.info(f"Not caching square {square_id} written by {sorted(models)}")
+        return
+    fingerprint = square_fingerprint(responses, square_id)
+    square_caches[square_id].put(fingerprint, (square, usage))
+    if disk_cache is not None:
+        await disk_cache.put(f"square:{fingerprint}", {"square": square.dict(), "usage": usage.dict()})
+
+async def get_cached_plan(fingerprint: str) -> Optional[MarketingPlan]:
+    """Look up a plan in the plan cache, then on disk"""
+    plan = plan_cache.get(fingerprint)
+    if plan is None and disk_cache is not None:
+        stored = await disk_cache.get(f"plan:{fingerprint}")
+        if stored is not None:
+            plan = MarketingPlan(**stored)
+            plan_cache.put(fingerprint, plan)
+    return plan
+
+async def cache_plan(fingerprint: str, plan: MarketingPlan):
+    """Store a generated plan in the plan cache and on disk"""
+    plan_cache.put(fingerprint, plan)
+    if disk_cache is not None:
+        await disk_cache.put(f"plan:{fingerprint}", plan.dict())
+
+def build_business_context(response_dict: Dict[str, Any]) -> str:
+    """Build the shared business context block used by every square prompt"""
+    return format_fields(response_dict, BUSINESS_CONTEXT_FIELDS)
+
+def build_square_context(response_dict: Dict[str, Any], square_id: int) -> str:
+    """Build the square-specific block of relevant questionnaire responses"""
+    return format_fields(response_dict, SQUARE_CONTEXT_FIELDS[square_id])
+
+# What each square's content should cover, spelled out in the square system prompt
+SQUARE_GUIDANCE = {
+    1: "Describe the one or two customer segments most worth pursuing first, with the roles, company types, budgets and triggers that make them buy. Name their most pressing pain points in their own words, where they look for solutions and who else influences the purchase, and point out segments the business should deliberately not chase.",
+    2: "State the core promise in one plain sentence a prospect would repeat to a colleague, then the proof behind it. Contrast the offer with the alternatives the customer actually weighs, including doing nothing, and give headline and message angles for each main segment and stage of awareness.",
+    3: "Choose the few channels where the target customers already spend attention and that the budget and team can sustain, explaining why each fits. Outline the content themes, formats and publishing cadence for each channel, and say which channels to test, scale back or drop.",
+    4: "Propose lead magnets, offers and calls to action matched to each channel and to how ready the visitor is to buy. Cover landing pages, forms and the information worth asking for, and define what makes a lead qualified so that sales and marketing agree on it.",
+    5: "Lay out the follow-up sequence from first contact to sales conversation: which messages go out, through which channels, at what intervals and triggered by what behaviour. Show how to segment and score leads, and how to stay useful to prospects who are not ready to buy yet.",
+    6: "Map the sales process from qualified lead to signed customer and pinpoint where deals stall. Recommend discovery questions, demos, proposals, pricing presentation, answers to common objections and follow-up tactics, and the few metrics that show whether conversion is improving.",
+    7: "Describe onboarding and delivery from the first day as a customer until they get the result they paid for. Identify the moments that most shape satisfaction, how to set expectations and communicate progress, and how to collect feedback and act on it before problems turn into churn.",
+    8: "Recommend ways to keep customers longer and grow what they spend: retention programmes, upsells, cross-sells, renewals and pricing changes. Tie each one to a point in the customer lifecycle, the signal that triggers it and the metric it should move.",
+    9: "Design a referral and advocacy system: when to ask, whom to ask, what to ask for and what the referrer and the referred customer receive. Include reviews, testimonials, case studies, partnerships and community, and how to track and reward the advocates who bring in business."
+}
+
+def create_square_system_prompt() -> str:
+    """Create the system prompt shared by every square call of every plan.
+
+    It holds the role, framework and output instructions but nothing from the questionnaire,
+    so together with SQUARE_TOOL it forms a prefix long enough to be served from the prompt cache.
+    """
+    framework = "\n\n".join(
+        f"{square_id}. {square_info['title']}: {square_info['description']}.\n{SQUARE_GUIDANCE[square_id]}"
+        for square_id, square_info in MARKETING_SQUARES.items()
+    )
+
+    return f"""You are a senior marketing strategist creating a comprehensive marketing plan for a business. The plan follows a 9-square marketing framework, and each request asks you for the content of one of its squares. You will be given the business context and the questionnaire responses relevant to that square; base every point on them rather than on generic marketing advice.
+
+THE 9-SQUARE FRAMEWORK:
+{framework}
+
+Each square should be consistent with the rest of the framework: refer to the same customer segments, value proposition and channels the business described, and do not repeat advice that belongs in another square.
 
-Please provide a JSON response with the following structure:
+Provide a JSON response with the following structure:
 {{
-    "title": "{square_info['title']}",
+    "title": "The title of the requested square",
     "summary": "A concise 1-2 sentence summary of this marketing square for this specific business",
     "keyPoints": [
         "4-6 specific, actionable key points based on the questionnaire responses",
@@ -279,69 +1173,1386 @@ Make sure all content is:
 4. Focused on the specific marketing square's objectives
 5. Consistent with their industry, size, and business model
 
+Where a response is missing or says "Not specified", make a reasonable assumption from the rest of the context and keep the advice useful rather than pointing out the gap.
+
+Return only valid JSON without any additional text or formatting."""
+
+SQUARE_SYSTEM_PROMPT = create_square_system_prompt()
+
+def create_claude_prompt(responses: List[QuestionnaireResponse], square_id: int) -> str:
+    """Create the user prompt for Claude to generate one square's content for this business"""
+    
+    response_dict = {r.questionId: r.answer for r in responses}
+    square_info = MARKETING_SQUARES[square_id]
+    
+    # Build context from responses
+    business_context = build_business_context(response_dict)
+    square_context = build_square_context(response_dict, square_id)
+
+    return f"""
+BUSINESS CONTEXT:
+{business_context}
+
+SQUARE FOCUS: {square_info['title']}
+DESCRIPTION: {square_info['description']}
+
+RELEVANT RESPONSES:
+{square_context}
+
+Generate the "{square_info['title']}" section now, using "{square_info['title']}" as the title.
+"""
+
+def create_whole_plan_prompt(responses: List[QuestionnaireResponse]) -> str:
+    """Create a single prompt asking Claude for all 9 marketing squares at once"""
+    
+    response_dict = {r.questionId: r.answer for r in responses}
+    business_context = build_business_context(response_dict)
+    
+    square_sections = "\n".join(
+        f"""SQUARE {square_id}: {square_info['title']}
+DESCRIPTION: {square_info['description']}
+RELEVANT RESPONSES:
+{build_square_context(response_dict, square_id)}"""
+        for square_id, square_info in MARKETING_SQUARES.items()
+    )
+
+    prompt = f"""
+You are a senior marketing strategist creating a comprehensive marketing plan. Based on the business information and questionnaire responses provided, generate detailed content for every section of a 9-square marketing framework.
+
+BUSINESS CONTEXT:
+{business_context}
+
+{square_sections}
+
+Please provide a JSON response with the following structure, with one entry per square keyed by its number ("1" to "9"):
+{{
+    "squares": {{
+        "1": {{
+            "title": "{MARKETING_SQUARES[1]['title']}",
+            "summary": "A concise 1-2 sentence summary of this marketing square for this specific business",
+            "keyPoints": [
+                "4-6 specific, actionable key points based on the questionnaire responses",
+                "Each point should be tailored to this business's specific situation",
+                "Include specific data/responses where relevant",
+                "Focus on insights derived from the provided information"
+            ],
+            "recommendations": [
+                "4-6 specific, actionable recommendations for this business",
+                "Each recommendation should be practical and implementable",
+                "Prioritize recommendations based on the business context",
+                "Include specific tactics, tools, or strategies where appropriate"
+            ]
+        }},
+        "2": {{ ... }}
+    }}
+}}
+
+Make sure all content is:
+1. Specific to this business based on their responses
+2. Actionable and practical
+3. Professional but accessible
+4. Focused on each marketing square's own objectives, without repeating content across squares
+5. Consistent with their industry, size, and business model
+
 Return only valid JSON without any additional text or formatting.
 """
     
     return prompt
 
+def fallback_square(square_id: int) -> MarketingSquare:
+    """Generic content used when Claude's response for a square cannot be parsed"""
+    return MarketingSquare(
+        title=MARKETING_SQUARES[square_id]["title"],
+        summary=f"AI-generated content for {MARKETING_SQUARES[square_id]['title']} based on your business profile.",
+        keyPoints=[
+            "Analysis of your specific business context",
+            "Tailored insights based on your responses",
+            "Strategic recommendations for this area",
+            "Implementation considerations"
+        ],
+        recommendations=[
+            "Develop a structured approach to this marketing area",
+            "Implement tracking and measurement systems",
+            "Regular review and optimization",
+            "Align with overall business objectives"
+        ]
+    )
+
+# Callback receiving (field, value) for each square field or list item as soon as it closes
+SquareEventCallback = Callable[[str, Any], Awaitable[None]]
+
+class SquareSchemaError(Exception):
+    """Raised while a square is streaming once its output cannot become a valid MarketingSquare"""
+
+class SquareStreamParser:
+    """Incremental parser and validator for the square JSON object as it streams in token by token.
+
+    Emits ("title" | "summary", value) when a top-level string field closes and
+    ("keyPoints" | "recommendations", item) when a list item closes. Anything before
+    the opening brace (e.g. a code fence) is ignored, up to MAX_PREAMBLE characters.
+    With validate, raises SquareSchemaError as soon as the object goes off-schema: an
+    unknown field, a value or list item of the wrong type, or a required field missing
+    at the close.
+    """
+
+    STRING_FIELDS = ("title", "summary")
+    LIST_FIELDS = ("keyPoints", "recommendations")
+    MAX_PREAMBLE = 200
+
+    def __init__(self, validate: bool = True):
+        self.validate = validate
+        self.stack: List[Dict[str, Any]] = []
+        self.started = False
+        self.finished = False
+        self.preamble = 0
+        self.string_buffer: Optional[List[str]] = None
+        self.escaped = False
+        self.fields: set = set()
+        # (kind, field) of the value whose first character must be checked next
+        self.expect: Optional[Tuple[str, str]] = None
+
+    def _fail(self, reason: str):
+        if self.validate:
+            raise SquareSchemaError(reason)
+
+    def _check_value_start(self, char: str):
+        kind, field = self.expect
+        self.expect = None
+        if kind == "item" and char == "]":
+            return
+        if kind == "array" and char != "[":
+            self._fail(f"{field} should be a list, got {char!r}")
+        if kind in ("string", "item") and char != '"':
+            self._fail(f"{field} {'items should be strings' if kind == 'item' else 'should be a string'}, got {char!r}")
+
+    def feed(self, chunk: str) -> List[Tuple[str, Any]]:
+        events = []
+        for char in chunk:
+            if self.finished:
+                break
+            if self.expect is not None and self.string_buffer is None and not char.isspace():
+                self._check_value_start(char)
+            if self.string_buffer is not None:
+                self.string_buffer.append(char)
+                if self.escaped:
+                    self.escaped = False
+                elif char == "\\":
+                    self.escaped = True
+                elif char == '"':
+                    events.extend(self._close_string(json.loads("".join(self.string_buffer))))
+                    self.string_buffer = None
+                continue
+
+            if not self.started:
+                if char == "{":
+                    self.started = True
+                    self.stack.append({"type": "object", "key": None, "expecting_key": True})
+                elif not char.isspace():
+                    self.preamble += 1
+                    if self.preamble > self.MAX_PREAMBLE:
+                        self._fail("Response does not start with a JSON object")
+                continue
+
+            top = self.stack[-1]
+            in_list_field = len(self.stack) == 2 and top["type"] == "array" and self.stack[0]["key"] in self.LIST_FIELDS
+            if char == '"':
+                self.string_buffer = [char]
+            elif char in "{[":
+                self.stack.append({
+                    "type": "object" if char == "{" else "array",
+                    "key": None,
+                    "expecting_key": char == "{"
+                })
+                if char == "[" and len(self.stack) == 2 and top["key"] in self.LIST_FIELDS:
+                    self.expect = ("item", top["key"])
+            elif char in "}]":
+                self.stack.pop()
+                if not self.stack:
+                    missing = [field for field in self.STRING_FIELDS + self.LIST_FIELDS if field not in self.fields]
+                    if missing:
+                        self._fail(f"Missing fields {missing}")
+                    self.finished = True
+            elif char == ":" and top["type"] == "object":
+                top["expecting_key"] = False
+                if len(self.stack) == 1:
+                    self.expect = ("array" if top["key"] in self.LIST_FIELDS else "string", top["key"])
+            elif char == "," and top["type"] == "object":
+                top["expecting_key"] = True
+            elif char == "," and in_list_field:
+                self.expect = ("item", self.stack[0]["key"])
+        return events
+
+    def _close_string(self, value: str) -> List[Tuple[str, Any]]:
+        top = self.stack[-1]
+        if top["type"] == "object" and top["expecting_key"]:
+            if len(self.stack) == 1:
+                if value not in self.STRING_FIELDS + self.LIST_FIELDS:
+                    self._fail(f"Unexpected field {value!r}")
+                self.fields.add(value)
+            top["key"] = value
+            return []
+        if len(self.stack) == 1:
+            return [(top["key"], value)]
+        parent = self.stack[-2]
+        if len(self.stack) == 2 and top["type"] == "array" and parent["key"] in self.LIST_FIELDS:
+            return [(parent["key"], value)]
+        return []
+
+def streamed_usage(stream: Any) -> Optional[Any]:
+    """Usage reported so far by a response stream, if it has started"""
+    try:
+        return stream.current_message_snapshot.usage
+    except (AssertionError, AttributeError):
+        return None
+
+async def create_message(
+    client: anthropic.AsyncAnthropic,
+    request_params: Dict[str, Any],
+    on_text: Optional[Callable[[str], Awaitable[None]]] = None
+) -> Any:
+    """Make one upstream Claude call.
+
+    The call waits for rate-limit budget and then for an upstream slot, feeds the response
+    headers back to the rate limiter and records token usage. When on_text is given the
+    response is streamed and on_text receives each chunk of text (or of tool call JSON).
+    """
+    max_tokens = request_params["max_tokens"]
+    await rate_limiter.acquire(max_tokens)
+    # Output tokens the call used, if known; otherwise the whole reservation is kept
+    output_tokens: Optional[int] = None
+    stats = model_stats(request_params["model"])
+    stats.calls += 1
+    try:
+        async with upstream_limiter.slot() as call:
+            started = time.monotonic()
+            if on_text is None:
+                raw = await client.messages.with_raw_response.create(**request_params)
+                headers = raw.headers
+                message = raw.parse()
+            else:
+                async with client.messages.stream(**request_params) as stream:
+                    headers = stream.response.headers
+                    try:
+                        # Text responses stream as text, tool calls as the partial JSON of their input
+                        async for event in stream:
+                            if event.type == "text":
+                                await on_text(event.text)
+                            elif event.type == "input_json":
+                                await on_text(event.partial_json)
+                    except BaseException:
+                        # Leaving the stream (also when a hedged request loses and is cancelled) closes it;
+                        # the tokens generated so far are billed all the same
+                        partial_usage = streamed_usage(stream)
+                        if partial_usage is not None:
+                            output_tokens = partial_usage.output_tokens
+                            record_usage(partial_usage, request_params["model"])
+                        raise
+                    message = await stream.get_final_message()
+            output_tokens = call["output_tokens"] = message.usage.output_tokens
+            stats.latencies.append(time.monotonic() - started)
+    except anthropic.APIStatusError as e:
+        # An error response generated no output (a stream that failed part-way counted what
+        # it streamed); the reservation is returned before its headers re-sync the bucket,
+        # as 529s usually carry none and the retries of an overload storm would drain it
+        rate_limiter.release(max_tokens, 0 if output_tokens is None else output_tokens)
+        rate_limiter.update(e.response.headers)
+        raise
+    except BaseException:
+        rate_limiter.release(max_tokens, max_tokens if output_tokens is None else output_tokens)
+        raise
+    rate_limiter.release(max_tokens, output_tokens)
+    rate_limiter.update(headers)
+    record_usage(message.usage, request_params["model"])
+    return message
+
+async def create_message_with_retry(
+    client: anthropic.AsyncAnthropic,
+    request_params: Dict[str, Any],
+    description: str,
+    on_text: Optional[Callable[[str], Awaitable[None]]] = None,
+    on_retry: Optional[Callable[[int], Awaitable[None]]] = None,
+    fallback_model: Optional[str] = None
+) -> Any:
+    """Make an upstream Claude call, retrying overloaded, 429, 5xx, timed-out and dropped attempts.
+
+    Retries back off exponentially with full jitter, up to UPSTREAM_MAX_ATTEMPTS attempts
+    and while the current plan's retry budget lasts. A 429's retry-after is honoured by the
+    rate limiter before the next attempt. on_retry receives the number of the attempt about
+    to start, so a streaming caller can discard what the failed attempt produced. With a
+    fallback_model, retries after MODEL_FALLBACK_AFTER failed attempts go to that model,
+    without backing off since it is not the model that was overloaded.
+    """
+    attempt = 1
+    while True:
+        try:
+            message = await create_message(client, request_params, on_text)
+            if attempt > 1:
+                retry_stats["recovered"] += 1
+            return message
+        except anthropic.APIError as e:
+            if not is_overload_error(e):
+                raise
+            model_stats(request_params["model"]).overloaded += 1
+            if attempt >= UPSTREAM_MAX_ATTEMPTS:
+                retry_stats["exhausted"] += 1
+                raise
+            budget = current_retry_budget.get()
+            if budget is not None and not budget.take():
+                retry_stats["budgetExhausted"] += 1
+                raise
+            if fallback_model is not None and request_params["model"] != fallback_model and attempt >= MODEL_FALLBACK_AFTER:
+                logger.warning(
+                    f"{description} failed with {type(e).__name__} on {request_params['model']} "
+                    f"(attempt {attempt}/{UPSTREAM_MAX_ATTEMPTS}), retrying on {fallback_model}"
+                )
+                request_params = {**request_params, "model": fallback_model}
+                retry_stats["fallbacks"] += 1
+                model_stats(fallback_model).fallbacks += 1
+            else:
+                delay = random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+                logger.warning(
+                    f"{description} failed with {type(e).__name__} (attempt {attempt}/{UPSTREAM_MAX_ATTEMPTS}), "
+                    f"retrying in {delay:.1f}s"
+                )
+                await asyncio.sleep(delay)
+            retry_stats["retries"] += 1
+            attempt += 1
+            if on_retry is not None:
+                await on_retry(attempt)
+
+# Tool Claude is made to call with a square's content when STRUCTURED_OUTPUT is on
+SQUARE_TOOL = {
+    "name": "record_marketing_square",
+    "description": "Record the content of one square of the marketing plan.",
+    "input_schema": {
+        "type": "object",
+        "properties": {
+            "title": {"type": "string", "description": "Square title"},
+            "summary": {"type": "string", "description": "A concise 1-2 sentence summary of this marketing square for this specific business"},
+            "keyPoints": {"type": "array", "items": {"type": "string"}, "description": "Key insights"},
+            "recommendations": {"type": "array", "items": {"type": "string"}, "description": "Actionable recommendations"}
+        },
+        "required": ["title", "summary", "keyPoints", "recommendations"]
+    }
+}
+
+# Square calls aborted because their streamed output went off-schema
+stream_validation_stats = {"aborted": 0, "retries": 0}
+
+# How square responses were parsed; wasted responses were paid for but only yielded fallback content
+structured_output_stats = {"responses": 0, "toolUse": 0, "text": 0, "repaired": 0, "wasted": 0}
+
+# Square responses cut off at max_tokens, and how they were finished: continuation calls made,
+# calls repeated with MAX_TOKENS_CEILING, and responses still unfinished when those ran out
+truncation_stats = {"truncated": 0, "continuations": 0, "repeated": 0, "unfinished": 0}
+
+class OutputLengthTracker:
+    """max_tokens per square learned from the output lengths of its recent responses.
+
+    The limit is reserved against the output-token rate limit for the whole call, so one
+    far above what a square actually writes holds back other calls, while one below it
+    costs a continuation call.
+    """
+
+    def __init__(
+        self,
+        initial: int,
+        floor: int,
+        ceiling: int,
+        percentile: float,
+        headroom: float,
+        min_samples: int,
+        window: int = 200
+    ):
+        self.initial = initial
+        self.floor = floor
+        self.ceiling = ceiling
+        self.percentile = percentile
+        self.headroom = headroom
+        self.min_samples = min_samples
+        self.window = window
+        self.samples: Dict[int, deque] = {}
+
+    def record(self, square_id: int, output_tokens: int):
+        self.samples.setdefault(square_id, deque(maxlen=self.window)).append(output_tokens)
+
+    def observed(self, square_id: int, percentile: float) -> Optional[int]:
+        samples = sorted(self.samples.get(square_id, ()))
+        if len(samples) < self.min_samples:
+            return None
+        return samples[min(len(samples) - 1, int(percentile * len(samples)))]
+
+    def limit(self, square_id: int, percentile: Optional[float] = None) -> int:
+        observed = self.observed(square_id, percentile or self.percentile)
+        if observed is None:
+            return self.initial
+        return max(self.floor, min(self.ceiling, math.ceil(observed * self.headroom)))
+
+    def stats(self) -> Dict[int, Dict[str, Any]]:
+        return {
+            square_id: {
+                "samples": len(self.samples.get(square_id, ())),
+                "p50": self.observed(square_id, 0.5),
+                "maxTokens": self.limit(square_id) if ADAPTIVE_MAX_TOKENS else SQUARE_MAX_TOKENS
+            }
+            for square_id in MARKETING_SQUARES
+        }
+
+output_lengths = OutputLengthTracker(
+    SQUARE_MAX_TOKENS, MAX_TOKENS_FLOOR, MAX_TOKENS_CEILING,
+    MAX_TOKENS_PERCENTILE, MAX_TOKENS_HEADROOM, MAX_TOKENS_MIN_SAMPLES
+)
+
+class HedgePolicy:
+    """When to send a hedged duplicate of a square request, and how many may be sent.
+
+    A square's hedge delay is a percentile of its recent request latencies. Each request
+    earns budget of a hedge, banked up to max_burst, and each hedge spends a whole one,
+    so hedges never add more than that fraction of extra requests.
+    """
+
+    def __init__(self, percentile: float, budget: float, min_samples: int, max_burst: float = 10.0, window: int = 1000):
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.max_burst = max_burst
+        self.window = window
+        self.latencies: Dict[int, deque] = {}
+        self.credit = 0.0
+        self.requests = 0
+        self.hedges = 0
+        self.wins = 0
+        self.denied = 0
+
+    def record(self, square_id: int, latency: float):
+        self.latencies.setdefault(square_id, deque(maxlen=self.window)).append(latency)
+
+    def delay(self, square_id: int) -> Optional[float]:
+        latencies = sorted(self.latencies.get(square_id, ()))
+        if len(latencies) < self.min_samples:
+            return None
+        return latencies[min(len(latencies) - 1, int(self.percentile * len(latencies)))]
+
+    def on_request(self):
+        self.requests += 1
+        self.credit = min(self.max_burst, self.credit + self.budget)
+
+    def try_hedge(self) -> bool:
+        if self.credit < 1:
+            self.denied += 1
+            return False
+        self.credit -= 1
+        self.hedges += 1
+        return True
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "enabled": HEDGE_REQUESTS,
+            "requests": self.requests,
+            "hedges": self.hedges,
+            "wins": self.wins,
+            "denied": self.denied,
+            "hedgeRate": self.hedges / max(1, self.requests),
+            "delaySeconds": {square_id: self.delay(square_id) for square_id in MARKETING_SQUARES}
+        }
+
+hedge_policy = HedgePolicy(HEDGE_PERCENTILE, HEDGE_BUDGET, HEDGE_MIN_SAMPLES)
+
+def square_request_params(responses: List[QuestionnaireResponse], square_id: int) -> Dict[str, Any]:
+    """Claude request for one square's content, sent to the square's primary model"""
+    route = SQUARE_ROUTES[square_id]
+    request_params = {
+        "model": route["model"],
+        "max_tokens": output_lengths.limit(square_id) if ADAPTIVE_MAX_TOKENS else SQUARE_MAX_TOKENS,
+        **route["params"],
+        "system": [{"type": "text", "text": SQUARE_SYSTEM_PROMPT}],
+        "messages": [
+            {
+                "role": "user",
+                "content": create_claude_prompt(responses, square_id)
+            }
+        ]
+    }
+    if PROMPT_CACHE:
+        # The breakpoint caches the tools and system prompt; below the model's minimum
+        # cacheable length the API ignores it and bills the prefix as normal input
+        request_params["system"][0]["cache_control"] = {"type": "ephemeral"}
+    if STRUCTURED_OUTPUT:
+        request_params["tools"] = [SQUARE_TOOL]
+        request_params["tool_choice"] = {"type": "tool", "name": SQUARE_TOOL["name"]}
+    return request_params
+
+def extract_json_object(text: str) -> Tuple[Dict[str, Any], bool]:
+    """Parse a JSON object from Claude's text, returning it and whether repair was needed.
+
+    Plain JSON is parsed directly; otherwise the first object in the text is decoded,
+    which skips code fences and any prose before or after it.
+    """
+    try:
+        data = json.loads(text)
+        repaired = False
+    except json.JSONDecodeError:
+        start = text.find("{")
+        if start < 0:
+            raise
+        data, _ = json.JSONDecoder().raw_decode(text, start)
+        repaired = True
+    if not isinstance(data, dict):
+        raise ValueError(f"Expected a JSON object, got {type(data).__name__}")
+    return data, repaired
+
+def message_text(message: Any) -> str:
+    """Text of a Claude response, or the JSON input of its tool call"""
+    for block in message.content:
+        if getattr(block, "type", "text") == "tool_use":
+            return json.dumps(block.input)
+    return "".join(block.text for block in message.content if getattr(block, "type", "text") == "text")
+
+def parse_square(square_id: int, message: Any, text: Optional[str] = None) -> MarketingSquare:
+    """Read a square from Claude's tool call or JSON text, falling back to generic content if it is invalid.
+
+    text, if given, is the whole output of a response that was finished by continuation calls.
+    """
+    structured_output_stats["responses"] += 1
+    tool_input = None
+    if text is None:
+        tool_input = next(
+            (block.input for block in message.content if getattr(block, "type", "text") == "tool_use"), None
+        )
+    try:
+        if tool_input is not None:
+            structured_output_stats["toolUse"] += 1
+            square_data = tool_input
+        else:
+            structured_output_stats["text"] += 1
+            square_data, repaired = extract_json_object(text if text is not None else message_text(message))
+            if repaired:
+                structured_output_stats["repaired"] += 1
+        return MarketingSquare(**square_data)
+    except (ValueError, TypeError, ValidationError) as e:
+        structured_output_stats["wasted"] += 1
+        logger.error(f"Failed to parse Claude response for square {square_id}: {e}")
+        return fallback_square(square_id)
+
+async def finish_truncated_square(
+    client: anthropic.AsyncAnthropic,
+    request_params: Dict[str, Any],
+    square_id: int,
+    message: Any,
+    streamed: Optional[str] = None,
+    on_text: Optional[Callable[[str], Awaitable[None]]] = None
+) -> Tuple[Any, Optional[str], int]:
+    """Finish a square response that was cut off at max_tokens.
+
+    The output so far (the streamed text or tool call JSON, or the text of an unstreamed
+    response) is sent back as the start of Claude's turn and Claude carries on from where
+    it stopped, up to MAX_CONTINUATIONS times; on_text receives each continuation. A
+    response that outgrew its square's learned limit is an outlier, so continuations are
+    sized for the longest recent response of the square, and at least SQUARE_MAX_TOKENS.
+    An unstreamed tool call has no partial JSON to continue from, so it is made again
+    with MAX_TOKENS_CEILING instead. Returns the last message, the assembled output (None
+    if the call was repeated) and the output tokens of the extra calls.
+    """
+    truncation_stats["truncated"] += 1
+    output_tokens = 0
+    fallback_model = SQUARE_ROUTES[square_id]["fallbackModel"]
+    # Finish with the model that wrote the response, which may be the fallback model
+    request_params = {**request_params, "model": message.model}
+    tool_call = any(getattr(block, "type", "text") == "tool_use" for block in message.content)
+    if streamed is None and tool_call:
+        if request_params["max_tokens"] < MAX_TOKENS_CEILING:
+            truncation_stats["repeated"] += 1
+            logger.warning(f"Square {square_id} tool call cut off at {request_params['max_tokens']} tokens, repeating it")
+            message = await create_message_with_retry(
+                client, {**request_params, "max_tokens": MAX_TOKENS_CEILING}, f"Square {square_id}",
+                fallback_model=fallback_model
+            )
+            output_tokens += message.usage.output_tokens
+        if message.stop_reason == "max_tokens":
+            truncation_stats["unfinished"] += 1
+        return message, None, output_tokens
+
+    text = streamed if streamed is not None else message_text(message)
+    # A prefilled turn cannot be combined with forced tool use; the prompt asks for the same JSON anyway
+    continuation_params = {key: value for key, value in request_params.items() if key not in ("tools", "tool_choice")}
+    if ADAPTIVE_MAX_TOKENS:
+        continuation_params["max_tokens"] = max(SQUARE_MAX_TOKENS, output_lengths.limit(square_id, 1.0))
+    for _ in range(MAX_CONTINUATIONS):
+        truncation_stats["continuations"] += 1
+        # The API rejects a final assistant turn that ends in whitespace
+        text = text.rstrip()
+        logger.warning(f"Square {square_id} cut off at max_tokens, continuing from {len(text)} characters")
+        message = await create_message_with_retry(client, {
+            **continuation_params,
+            "messages": request_params["messages"] + [{"role": "assistant", "content": text}]
+        }, f"Square {square_id} continuation", fallback_model=fallback_model)
+        output_tokens += message.usage.output_tokens
+        continuation = message_text(message)
+        if on_text is not None:
+            await on_text(continuation)
+        text += continuation
+        if message.stop_reason != "max_tokens":
+            return message, text, output_tokens
+    truncation_stats["unfinished"] += 1
+    return message, text, output_tokens
+
+async def request_square(
+    responses: List[QuestionnaireResponse],
+    square_id: int,
+    client: anthropic.AsyncAnthropic,
+    on_event: Optional[SquareEventCallback] = None
+) -> MarketingSquare:
+    """Request a square's content from Claude, with its retries and continuations (see generate_square_content)"""
+    request_params = square_request_params(responses, square_id)
+    
+    on_text = None
+    on_retry = None
+    # Calls made for this square, and those whose output went off-schema; overload retries
+    # made by create_message_with_retry count towards the first but not the schema allowance
+    attempt = 1
+    schema_attempts = 1
+    # Raw output of the current attempt, kept to continue from if it is cut off
+    output: List[str] = []
+    if on_event is not None or STREAM_VALIDATION:
+        parser = SquareStreamParser(STREAM_VALIDATION)
+
+        async def on_text(text: str):
+            output.append(text)
+            for field, value in parser.feed(text):
+                if on_event is not None:
+                    await on_event(field, value)
+
+        async def on_retry(_: int):
+            nonlocal parser, attempt
+            parser = SquareStreamParser(STREAM_VALIDATION)
+            output.clear()
+            attempt += 1
+            if on_event is not None:
+                await on_event("retry", attempt)
+
+    while True:
+        try:
+            message = await create_message_with_retry(
+                client, request_params, f"Square {square_id}", on_text, on_retry, SQUARE_ROUTES[square_id]["fallbackModel"]
+            )
+            output_tokens = message.usage.output_tokens
+            text = None
+            if message.stop_reason == "max_tokens":
+                message, text, continuation_tokens = await finish_truncated_square(
+                    client, request_params, square_id, message,
+                    "".join(output) if on_text is not None else None, on_text
+                )
+                output_tokens += continuation_tokens
+            break
+        except SquareSchemaError as e:
+            stream_validation_stats["aborted"] += 1
+            budget = current_retry_budget.get()
+            if schema_attempts >= SCHEMA_MAX_ATTEMPTS or (budget is not None and not budget.take()):
+                logger.error(f"Square {square_id} still off-schema after {schema_attempts} attempts: {e}")
+                structured_output_stats["responses"] += 1
+                structured_output_stats["wasted"] += 1
+                return fallback_square(square_id)
+            logger.warning(f"Square {square_id} went off-schema, retrying: {e}")
+            stream_validation_stats["retries"] += 1
+            schema_attempts += 1
+            await on_retry(attempt)
+    
+    if message.stop_reason != "max_tokens":
+        output_lengths.record(square_id, output_tokens)
+
+    # Parse Claude's response
+    logger.info(f"Claude response for square {square_id}: {(text or message_text(message))[:200]}...")
+    return parse_square(square_id, message, text)
+
+async def request_square_hedged(
+    responses: List[QuestionnaireResponse],
+    square_id: int,
+    client: anthropic.AsyncAnthropic,
+    on_event: Optional[SquareEventCallback] = None
+) -> MarketingSquare:
+    """Request a square, sending a duplicate request if the first is slower than the square usually is.
+
+    The first valid square wins and the other request is cancelled; generic fallback
+    content or an error only counts once both requests have finished. on_event receives
+    the items of both requests.
+    """
+    async def timed_request() -> MarketingSquare:
+        started = time.monotonic()
+        try:
+            return await request_square(responses, square_id, client, on_event)
+        finally:
+            # A cancelled loser took at least this long; leaving it out would drag the percentile down
+            hedge_policy.record(square_id, time.monotonic() - started)
+
+    hedge_policy.on_request()
+    delay = hedge_policy.delay(square_id)
+    tasks = [asyncio.create_task(timed_request())]
+    try:
+        if delay is not None:
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            if not done and hedge_policy.try_hedge():
+                logger.info(f"Square {square_id} still running after {delay:.1f}s, sending a hedged request")
+                tasks.append(asyncio.create_task(timed_request()))
+
+        pending = set(tasks)
+        square = None
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                try:
+                    result = task.result()
+                except Exception as e:
+                    error = error or e
+                    continue
+                if result != fallback_square(square_id):
+                    if task is not tasks[0]:
+                        hedge_policy.wins += 1
+                    return result
+                square = result
+        if square is None:
+            raise error
+        return square
+    finally:
+        # Cancel the slower request; its tokens so far are still billed
+        for task in tasks:
+            task.cancel()
+
 async def generate_square_content(
     responses: List[QuestionnaireResponse], 
     square_id: int,
-    client: anthropic.Anthropic
+    client: anthropic.AsyncAnthropic,
+    on_event: Optional[SquareEventCallback] = None,
+    hedge: bool = True
 ) -> MarketingSquare:
-    """Generate content for a specific marketing square using Claude"""
+    """Generate content for a specific marketing square using Claude.
+
+    When on_event is given the response is streamed and each field or list item is
+    reported as soon as it is complete; if the call is retried, on_event receives
+    ("retry", attempt) and the square's items are reported again from the start.
+    With STREAM_VALIDATION the response is always streamed and validated as it arrives,
+    and a call whose output goes off-schema is aborted and retried. A response cut off
+    at max_tokens is finished by continuation calls. With HEDGE_REQUESTS and hedge, a
+    square that runs slow gets a hedged duplicate request; callers whose on_event
+    forwards items to a client pass hedge=False so items are not reported twice.
+    """
     
+    route_token = current_route.set(str(square_id))
     try:
-        prompt = create_claude_prompt(responses, square_id)
+        if HEDGE_REQUESTS and hedge:
+            return await request_square_hedged(responses, square_id, client, on_event)
+        return await request_square(responses, square_id, client, on_event)
         
-        message = client.messages.create(
-            model="claude-3-5-sonnet-20241022",
-            max_tokens=1000,
-            temperature=0.7,
-            messages=[
+    except UpstreamOverloadedError:
+        raise
+    except Exception as e:
+        logger.error(f"Error generating content for square {square_id}: {e}")
+        raise HTTPException(status_code=500, detail=f"Failed to generate content for square {square_id}")
+    finally:
+        current_route.reset(route_token)
+
+async def iter_squares(
+    responses: List[QuestionnaireResponse],
+    client: anthropic.AsyncAnthropic,
+    max_concurrency: Optional[int] = None,
+    on_event: Optional[Callable[[int, str, Any], Awaitable[None]]] = None,
+    square_ids: Optional[List[int]] = None,
+    use_cache: bool = True,
+    allow_partial: bool = False
+) -> AsyncIterator[Tuple[int, Optional[MarketingSquare]]]:
+    """Generate squares concurrently (all 9 unless square_ids is given), yielding each one as soon as it completes.
+
+    If on_event is given, squares are token-streamed and on_event receives
+    (square_id, field, value) for every field or list item as it closes.
+    Squares found in the per-square cache are yielded first without calling Claude.
+    A square that cannot be generated stops the others, unless allow_partial is set,
+    in which case it is yielded as None and the others carry on.
+    """
+    semaphore = asyncio.Semaphore(max_concurrency or SQUARE_CONCURRENCY)
+    cached_squares = {}
+    if use_cache:
+        for square_id in square_ids or MARKETING_SQUARES:
+            square = await get_cached_square(responses, square_id)
+            if square is not None:
+                cached_squares[square_id] = square
+    square_ids = [square_id for square_id in (square_ids or MARKETING_SQUARES) if square_id not in cached_squares]
+
+    async def run(square_id: int) -> Tuple[int, Optional[MarketingSquare]]:
+        async with semaphore:
+            logger.info(f"Generating content for square {square_id}")
+            square_callback = None
+            if on_event is not None:
+                async def square_callback(field: str, value: Any):
+                    await on_event(square_id, field, value)
+            square_usage = PlanUsage()
+            current_square_usage.set(square_usage)
+            square_models: Set[str] = set()
+            current_square_models.set(square_models)
+            try:
+                square = await generate_square_content(
+                    responses, square_id, client, square_callback, hedge=on_event is None
+                )
+            except Exception as e:
+                if not allow_partial:
+                    raise
+                logger.error(f"Leaving square {square_id} out of the plan: {e}")
+                return square_id, None
+            await cache_square(responses, square_id, square, square_usage, square_models)
+            return square_id, square
+
+    tasks = [asyncio.create_task(run(square_id)) for square_id in square_ids]
+    try:
+        for square_id, square in cached_squares.items():
+            yield square_id, square
+        for next_done in asyncio.as_completed(tasks):
+            yield await next_done
+    finally:
+        # Stop outstanding upstream calls if a square failed or the consumer went away
+        for task in tasks:
+            task.cancel()
+
+async def generate_all_squares(
+    responses: List[QuestionnaireResponse],
+    client: anthropic.AsyncAnthropic,
+    max_concurrency: Optional[int] = None,
+    square_ids: Optional[List[int]] = None,
+    use_cache: bool = True,
+    allow_partial: bool = False,
+    on_square: Optional[Callable[[int, Optional[MarketingSquare]], None]] = None
+) -> Dict[int, MarketingSquare]:
+    """Generate squares concurrently (all 9 unless square_ids is given), bounded by max_concurrency.
+
+    With allow_partial, squares that could not be generated are missing from the result.
+    on_square is told about each square as it completes (None if it failed).
+    """
+    squares = {}
+    async for square_id, square in iter_squares(
+        responses, client, max_concurrency, square_ids=square_ids, use_cache=use_cache, allow_partial=allow_partial
+    ):
+        if on_square is not None:
+            on_square(square_id, square)
+        if square is not None:
+            squares[square_id] = square
+    return {square_id: squares[square_id] for square_id in (square_ids or MARKETING_SQUARES) if square_id in squares}
+
+async def generate_whole_plan(
+    responses: List[QuestionnaireResponse],
+    client: anthropic.AsyncAnthropic,
+    allow_partial: bool = False
+) -> Dict[int, MarketingSquare]:
+    """Generate all 9 squares with a single Claude call.
+
+    Squares missing or invalid in the combined response are generated individually, as
+    are all of them if allow_partial is set and the combined call fails.
+    """
+    squares = {}
+    route_token = current_route.set("wholePlan")
+    try:
+        message = await create_message_with_retry(client, {
+            "model": STANDARD_MODEL,
+            "max_tokens": WHOLE_PLAN_MAX_TOKENS,
+            "temperature": 0.7,
+            "messages": [
                 {
                     "role": "user",
-                    "content": prompt
+                    "content": create_whole_plan_prompt(responses)
                 }
             ]
-        )
-        
-        # Parse Claude's response
-        response_text = message.content[0].text
-        logger.info(f"Claude response for square {square_id}: {response_text[:200]}...")
+        }, "Whole plan")
+        response_text = message_text(message)
+        logger.info(f"Claude whole-plan response: {response_text[:200]}...")
         
-        # Parse JSON response
-        square_data = json.loads(response_text)
-        
-        return MarketingSquare(
-            title=square_data["title"],
-            summary=square_data["summary"],
-            keyPoints=square_data["keyPoints"],
-            recommendations=square_data["recommendations"]
-        )
+        squares_data = extract_json_object(response_text)[0].get("squares", {})
+        for square_id in MARKETING_SQUARES:
+            try:
+                squares[square_id] = MarketingSquare(**squares_data[str(square_id)])
+            except (KeyError, TypeError, ValidationError) as e:
+                logger.error(f"Whole-plan response has no valid square {square_id}: {e}")
+    except (ValueError, AttributeError) as e:
+        logger.error(f"Failed to parse Claude whole-plan response: {e}")
+    except anthropic.APIError as e:
+        if not allow_partial or not is_overload_error(e):
+            raise
+        logger.error(f"Whole-plan call failed: {e}")
+    finally:
+        current_route.reset(route_token)
+
+    missing = [square_id for square_id in MARKETING_SQUARES if square_id not in squares]
+    if missing:
+        logger.info(f"Generating squares {missing} individually")
+        squares.update(await generate_all_squares(
+            responses, client, square_ids=missing, allow_partial=allow_partial
+        ))
+    return {square_id: squares[square_id] for square_id in MARKETING_SQUARES if square_id in squares}
+
+def square_statuses(squares: Dict[int, MarketingSquare]) -> Dict[int, SquareStatus]:
+    """Status of each of the 9 squares given the squares that were generated"""
+    statuses = {}
+    for square_id in MARKETING_SQUARES:
+        if square_id not in squares:
+            statuses[square_id] = "failed"
+        elif squares[square_id] == fallback_square(square_id):
+            statuses[square_id] = "fallback"
+        else:
+            statuses[square_id] = "complete"
+    return statuses
+
+def incomplete_squares(plan: MarketingPlan) -> List[int]:
+    """Squares of a plan that are missing or only have fallback content"""
+    statuses = plan.squareStatus or square_statuses(plan.squares)
+    return [square_id for square_id in MARKETING_SQUARES if statuses.get(square_id) != "complete"]
+
+def store_plan(
+    business_context: BusinessContext,
+    squares: Dict[int, MarketingSquare],
+    usage: Optional[PlanUsage] = None,
+    responses: Optional[List[QuestionnaireResponse]] = None
+) -> MarketingPlan:
+    """Create a marketing plan from generated squares and store it"""
+    plan_id = str(uuid.uuid4())
+    plan = MarketingPlan(
+        businessContext=business_context,
+        squares=squares,
+        generatedAt=datetime.utcnow().isoformat(),
+        planId=plan_id,
+        usage=usage,
+        squareStatus=square_statuses(squares),
+        responses=responses
+    )
+    plans_storage[plan_id] = plan
+    return plan
+
+def store_cached_plan(plan: MarketingPlan) -> MarketingPlan:
+    """Store a copy of a cached plan under a new planId.
+
+    Every client served from the cache gets its own plan, so one client's update,
+    regeneration or deletion never reaches another's, and a stored plan is never overwritten.
+    """
+    plan = plan.copy(deep=True, update={"planId": str(uuid.uuid4()), "generatedAt": datetime.utcnow().isoformat()})
+    plans_storage[plan.planId] = plan
+    return plan
+
+async def update_plan_squares(
+    plan_id: str,
+    plan: MarketingPlan,
+    squares: Dict[int, Optional[MarketingSquare]],
+    usage: PlanUsage,
+    responses: Optional[List[QuestionnaireResponse]] = None
+) -> MarketingPlan:
+    """Replace squares of a stored plan (removing those given as None), add the usage spent on them, and store it.
+
+    If responses is given it replaces the plan's questionnaire and business context.
+    The plan is re-read from storage in case it was replaced while the squares were
+    generating, and cached for its questionnaire once it is complete.
+    """
+    plan = plans_storage.get(plan_id, plan)
+    merged = {**plan.squares, **squares}
+    merged = {square_id: merged[square_id] for square_id in MARKETING_SQUARES if merged.get(square_id) is not None}
+    total_usage = PlanUsage(**(plan.usage or PlanUsage()).dict())
+    total_usage.add(usage)
+    update = {"squares": merged, "squareStatus": square_statuses(merged), "usage": total_usage}
+    if responses is not None:
+        update.update(responses=responses, businessContext=extract_business_context(responses))
+    plan = plan.copy(update=update)
+    plans_storage[plan_id] = plan
+    if plan.responses is not None and not incomplete_squares(plan):
+        await cache_plan(questionnaire_fingerprint(plan.responses), plan)
+    return plan
+
+# CSV upload columns that set GeneratePlanRequest options rather than answer a question
+BULK_CSV_OPTIONS = {"maxConcurrency", "generationMode", "bypassCache", "allowPartial"}
+
+async def iter_upload_lines(body: AsyncIterator[bytes]) -> AsyncIterator[str]:
+    """Decode an uploaded body into lines as it arrives, gunzipping it if it is gzip-compressed"""
+    decompressor = None
+    buffer = b""
+    first = True
+    async for chunk in body:
+        if first and chunk:
+            if chunk[:2] == b"\x1f\x8b":
+                decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            first = False
+        buffer += decompressor.decompress(chunk) if decompressor is not None else chunk
+        *lines, buffer = buffer.split(b"\n")
+        for line in lines:
+            yield line.decode("utf-8-sig" if line.startswith(b"\xef\xbb\xbf") else "utf-8")
+    if decompressor is not None:
+        buffer += decompressor.flush()
+    if buffer:
+        yield buffer.decode("utf-8")
+
+def csv_row_to_request(header: List[str], row: List[str]) -> Dict[str, Any]:
+    """Turn a CSV row into GeneratePlanRequest data.
+
+    Each column is a questionId, apart from the BULK_CSV_OPTIONS columns; empty cells are
+    unanswered and cells containing "|" are multi-select answers.
+    """
+    record: Dict[str, Any] = {"responses": []}
+    for column, cell in zip(header, row):
+        cell = cell.strip()
+        if not cell:
+            continue
+        if column in BULK_CSV_OPTIONS:
+            record[column] = cell
+        else:
+            answer: Any = [part.strip() for part in cell.split("|")] if "|" in cell else cell
+            record["responses"].append({"questionId": column, "answer": answer})
+    return record
+
+async def iter_bulk_records(
+    body: AsyncIterator[bytes],
+    upload_format: Literal["jsonl", "csv"]
+) -> AsyncIterator[Tuple[int, Union[Dict[str, Any], str]]]:
+    """Parse an upload into (line number, GeneratePlanRequest data or error message) one record at a time"""
+    header: Optional[List[str]] = None
+    record_line = 0
+    pending = ""
+    line_number = 0
+    async for line in iter_upload_lines(body):
+        line_number += 1
+        if upload_format == "jsonl":
+            if not line.strip():
+                continue
+            try:
+                yield line_number, json.loads(line)
+            except json.JSONDecodeError as e:
+                yield line_number, f"Invalid JSON: {e}"
+            continue
         
-    except json.JSONDecodeError as e:
-        logger.error(f"Failed to parse Claude response for square {square_id}: {e}")
-        # Fallback content
-        return MarketingSquare(
-            title=MARKETING_SQUARES[square_id]["title"],
-            summary=f"AI-generated content for {MARKETING_SQUARES[square_id]['title']} based on your business profile.",
-            keyPoints=[
-                "Analysis of your specific business context",
-                "Tailored insights based on your responses",
-                "Strategic recommendations for this area",
-                "Implementation considerations"
-            ],
-            recommendations=[
-                "Develop a structured approach to this marketing area",
-                "Implement tracking and measurement systems",
-                "Regular review and optimization",
-                "Align with overall business objectives"
-            ]
-        )
+        # A CSV record may span lines inside a quoted field; it is complete once its quotes balance
+        if not pending:
+            record_line = line_number
+        pending += line.rstrip("\r") + "\n"
+        if pending.count('"') % 2:
+            continue
+        row = next(csv.reader([pending]), [])
+        pending = ""
+        if not any(cell.strip() for cell in row):
+            continue
+        if header is None:
+            header = [column.strip() for column in row]
+        else:
+            yield record_line, csv_row_to_request(header, row)
+    if pending:
+        yield record_line, "Unterminated quoted CSV field"
+
+class UploadStreamingResponse(StreamingResponse):
+    """StreamingResponse for endpoints that keep reading the request body while they respond.
+
+    StreamingResponse may watch for a client disconnect by consuming receive(), which would
+    steal the body chunks from request.stream(); here a disconnect surfaces as a send error.
+    """
+
+    async def __call__(self, scope, receive, send):
+        await self.stream_response(send)
+
+def format_sse(event: str, data: Any) -> str:
+    """Format a Server-Sent Events message"""
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+async def create_plan(
+    request: GeneratePlanRequest,
+    client: anthropic.AsyncAnthropic,
+    fingerprint: str,
+    on_square: Optional[Callable[[int, Optional[MarketingSquare]], None]] = None
+) -> MarketingPlan:
+    """Generate, store and cache a marketing plan.
+
+    With request.allowPartial a plan missing the squares that failed is stored and
+    returned; only complete plans are cached. In per-square mode on_square is told
+    about each square as it completes.
+    """
+    
+    # Shed load before spending anything on a plan that cannot be admitted
+    whole_plan = (request.generationMode or GENERATION_MODE) == "whole-plan"
+    calls = 1 if whole_plan else len(MARKETING_SQUARES)
+    upstream_limiter.admit(calls)
+    
+    # Extract business context
+    business_context = extract_business_context(request.responses)
+    usage = PlanUsage()
+    current_plan_usage.set(usage)
+    current_retry_budget.set(RetryBudget(PLAN_RETRY_BUDGET))
+    current_plan_admitted.set(True)
+    
+    # Generate content for all 9 squares
+    try:
+        if whole_plan:
+            squares = await generate_whole_plan(request.responses, client, request.allowPartial)
+        else:
+            squares = await generate_all_squares(
+                request.responses, client, request.maxConcurrency,
+                use_cache=not request.bypassCache, allow_partial=request.allowPartial, on_square=on_square
+            )
+    finally:
+        upstream_limiter.release(calls)
+    if not squares:
+        raise HTTPException(status_code=500, detail="Failed to generate any marketing square")
+    
+    # Create and store the marketing plan
+    plan = store_plan(business_context, squares, usage, request.responses)
+    missing = incomplete_squares(plan)
+    if missing:
+        logger.warning(f"Generated partial plan {plan.planId}, squares {missing} incomplete")
+    else:
+        await cache_plan(fingerprint, plan)
+    
+    logger.info(f"Successfully generated plan {plan.planId} ({usage.cacheReadInputTokens} cache read tokens)")
+    return plan
+
+async def run_single_flight(
+    key: str,
+    generate: Callable[[Callable[[int, Optional[MarketingSquare]], None]], Awaitable[MarketingPlan]],
+    on_square: Optional[Callable[[int, Optional[MarketingSquare]], None]] = None
+) -> Tuple[MarketingPlan, bool]:
+    """Run generate(on_square) unless an identical generation is already in flight, in which case wait for that one.
+
+    Returns the plan and whether this call was coalesced onto an existing generation.
+    Every caller's on_square is told about each square as it completes, including the
+    squares completed before it attached. A coalesced caller gets its own copy of the
+    plan. The generation runs in its own task so a disconnecting client does not cancel
+    it for the others.
+    """
+    task = inflight_plans.get(key)
+    if task is not None:
+        single_flight_stats["coalesced"] += 1
+        listeners, completed = inflight_progress[key]
+        if on_square is not None:
+            for square_id, square in list(completed.items()):
+                on_square(square_id, square)
+            listeners.append(on_square)
+        plan = await asyncio.shield(task)
+        single_flight_stats["upstreamCallsSaved"] += plan.usage.requests if plan.usage else 0
+        return store_cached_plan(plan), True
+
+    listeners = [on_square] if on_square is not None else []
+    completed: Dict[int, Optional[MarketingSquare]] = {}
+
+    def broadcast(square_id: int, square: Optional[MarketingSquare]):
+        completed[square_id] = square
+        for listener in listeners:
+            listener(square_id, square)
+
+    task = asyncio.create_task(generate(broadcast))
+    inflight_plans[key] = task
+    inflight_progress[key] = (listeners, completed)
+    single_flight_stats["generations"] += 1
+
+    def release(finished: asyncio.Task):
+        if inflight_plans.get(key) is finished:
+            del inflight_plans[key]
+            del inflight_progress[key]
+
+    task.add_done_callback(release)
+    return await asyncio.shield(task), False
+
+async def get_or_create_plan(
+    request: GeneratePlanRequest,
+    client: anthropic.AsyncAnthropic,
+    on_square: Optional[Callable[[int, Optional[MarketingSquare]], None]] = None
+) -> Tuple[MarketingPlan, bool, bool]:
+    """Serve a plan from the plan cache, join an identical generation in flight, or generate it.
+
+    Returns the plan and whether it was cached and whether it was coalesced.
+    """
+    fingerprint = questionnaire_fingerprint(request.responses)
+    cached_plan = None if request.bypassCache else await get_cached_plan(fingerprint)
+    if cached_plan is not None:
+        plan = store_cached_plan(cached_plan)
+        logger.info(f"Serving cached plan {cached_plan.planId} as {plan.planId}")
+        return plan, True, False
+    
+    mode = request.generationMode or GENERATION_MODE
+    # A partial plan must not reach a client that asked for all or nothing, nor a strict
+    # generation's failure one that accepts a partial plan
+    plan, coalesced = await run_single_flight(
+        f"{mode}:{'partial' if request.allowPartial else 'complete'}:{fingerprint}",
+        lambda broadcast: create_plan(request, client, fingerprint, broadcast),
+        on_square
+    )
+    return plan, False, coalesced
+
+async def wait_for_plan(
+    request: GeneratePlanRequest,
+    client: anthropic.AsyncAnthropic,
+    description: str,
+    on_square: Optional[Callable[[int, Optional[MarketingSquare]], None]] = None
+) -> Tuple[MarketingPlan, bool]:
+    """Like get_or_create_plan, but for offline work: waits out the Retry-After instead of being shed.
+
+    Returns the plan and whether it was cached.
+    """
+    while True:
+        try:
+            plan, cached, _ = await get_or_create_plan(request, client, on_square)
+            return plan, cached
+        except UpstreamOverloadedError as e:
+            logger.warning(f"{description} waiting {e.retry_after}s for upstream capacity")
+            await asyncio.sleep(e.retry_after)
+
+def square_progress(square_id: int, square: Optional[MarketingSquare]) -> SquareProgress:
+    if square is None:
+        return "failed"
+    return "fallback" if square == fallback_square(square_id) else "complete"
+
+async def run_job(job: Job, request: GeneratePlanRequest, client: anthropic.AsyncAnthropic):
+    """Generate the plan for a job, recording progress on the job as squares complete.
+
+    Unlike a synchronous request, a job that finds upstream at capacity is not shed but
+    waits for the suggested Retry-After and tries again.
+    """
+    job.status = "running"
+    job.startedAt = datetime.utcnow().isoformat()
+
+    def on_square(square_id: int, square: Optional[MarketingSquare]):
+        job.squares[square_id] = square_progress(square_id, square)
+
+    try:
+        plan, job.cached = await wait_for_plan(request, client, f"Job {job.jobId}", on_square)
+        job.squares = {
+            square_id: square_progress(square_id, plan.squares.get(square_id)) for square_id in MARKETING_SQUARES
+        }
+        job.planId = plan.planId
+        job.status = "done"
+        logger.info(f"Job {job.jobId} finished with plan {plan.planId}")
     except Exception as e:
-        logger.error(f"Error generating content for square {square_id}: {e}")
-        raise HTTPException(status_code=500, detail=f"Failed to generate content for square {square_id}")
+        logger.error(f"Job {job.jobId} failed: {e}")
+        job.error = e.detail if isinstance(e, HTTPException) else str(e)
+        job.status = "failed"
+    finally:
+        job.finishedAt = datetime.utcnow().isoformat()
+
+async def job_worker():
+    """Run queued jobs one at a time"""
+    while True:
+        job, request, client = await job_queue.get()
+        try:
+            await run_job(job, request, client)
+        finally:
+            job_queue.task_done()
+
+def prune_jobs():
+    """Forget finished jobs older than JOB_TTL"""
+    now = datetime.utcnow()
+    for job_id, job in list(jobs.items()):
+        if job.finishedAt and (now - datetime.fromisoformat(job.finishedAt)).total_seconds() > JOB_TTL:
+            del jobs[job_id]
+
+async def wait_for_batch(
+    client: anthropic.AsyncAnthropic,
+    batch_id: str,
+    poll_interval: float,
+    on_progress: Optional[Callable[[Any], None]] = None
+) -> Any:
+    """Poll a Message Batch until it has ended"""
+    while True:
+        batch = await client.messages.batches.retrieve(batch_id)
+        if on_progress is not None:
+            on_progress(batch)
+        if batch.processing_status == "ended":
+            return batch
+        await asyncio.sleep(poll_interval)
+
+async def generate_plans_batch(
+    questionnaires: List[List[QuestionnaireResponse]],
+    client: anthropic.AsyncAnthropic,
+    use_cache: bool = True,
+    batch_job: Optional[BatchJob] = None,
+    poll_interval: Optional[float] = None
+) -> List[MarketingPlan]:
+    """Generate and store a plan per questionnaire through the Message Batches API.
+
+    Batches cost half as much as interactive calls and count against a separate rate
+    limit, but may take hours, so they bypass the admission controller and rate limiter.
+    Plans and squares already cached are not resubmitted. Squares whose request did not
+    succeed are left out of their plan, which can be completed later with /fill.
+    """
+    squares: List[Dict[int, MarketingSquare]] = [{} for _ in questionnaires]
+    usages = [PlanUsage() for _ in questionnaires]
+    cached_plans: Dict[int, MarketingPlan] = {}
+    requests = []
+    for index, responses in enumerate(questionnaires):
+        if use_cache:
+            plan = await get_cached_plan(questionnaire_fingerprint(responses))
+            if plan is not None:
+                cached_plans[index] = plan
+                continue
+        for square_id in MARKETING_SQUARES:
+            square = await get_cached_square(responses, square_id) if use_cache else None
+            if square is not None:
+                squares[index][square_id] = square
+            else:
+                requests.append({
+                    "custom_id": f"plan-{index}-square-{square_id}",
+                    "params": square_request_params(responses, square_id)
+                })
+
+    batch_ids = []
+    for start in range(0, len(requests), BATCH_MAX_REQUESTS):
+        chunk = requests[start:start + BATCH_MAX_REQUESTS]
+        batch = await client.messages.batches.create(requests=chunk)
+        logger.info(f"Submitted message batch {batch.id} with {len(chunk)} requests")
+        batch_ids.append(batch.id)
+    if batch_job is not None:
+        batch_job.anthropicBatchIds = batch_ids
+
+    counts: Dict[str, Dict[str, int]] = {}
+
+    def on_progress(batch: Any):
+        counts[batch.id] = {
+            status: getattr(batch.request_counts, status)
+            for status in ("processing", "succeeded", "errored", "canceled", "expired")
+        }
+        if batch_job is not None:
+            batch_job.requestCounts = {
+                status: sum(batch_counts[status] for batch_counts in counts.values())
+                for status in counts[batch.id]
+            }
+
+    for batch_id in batch_ids:
+        await wait_for_batch(client, batch_id, poll_interval or BATCH_POLL_INTERVAL, on_progress)
+        async for result in await client.messages.batches.results(batch_id):
+            _, index, _, square_id = result.custom_id.split("-")
+            index, square_id = int(index), int(square_id)
+            if result.result.type != "succeeded":
+                logger.error(f"Batch request {result.custom_id} did not succeed: {result.result.type}")
+                continue
+            message = result.result.message
+            if message.stop_reason != "max_tokens":
+                output_lengths.record(square_id, message.usage.output_tokens)
+            square = parse_square(square_id, message)
+            usage = usage_from_response(message.usage)
+            usages[index].add(usage)
+            squares[index][square_id] = square
+            # Batch requests are only ever sent to the square's primary model
+            await cache_square(questionnaires[index], square_id, square, usage, {SQUARE_ROUTES[square_id]["model"]})
+
+    plans = []
+    for index, responses in enumerate(questionnaires):
+        if index in cached_plans:
+            plan = store_cached_plan(cached_plans[index])
+        else:
+            plan_squares = {square_id: squares[index][square_id] for square_id in MARKETING_SQUARES if square_id in squares[index]}
+            plan = store_plan(extract_business_context(responses), plan_squares, usages[index], responses)
+            if not incomplete_squares(plan):
+                await cache_plan(questionnaire_fingerprint(responses), plan)
+        plans.append(plan)
+    logger.info(f"Generated {len(plans)} plans from {len(requests)} batch requests")
+    return plans
+
+async def run_batch_job(batch_job: BatchJob, request: BatchPlanRequest, client: anthropic.AsyncAnthropic):
+    """Generate the plans for a batch job, recording its progress"""
+    batch_job.status = "running"
+    try:
+        plans = await generate_plans_batch(request.questionnaires, client, not request.bypassCache, batch_job)
+        batch_job.planIds = [plan.planId for plan in plans]
+        batch_job.status = "done"
+    except Exception as e:
+        logger.error(f"Batch job {batch_job.batchJobId} failed: {e}")
+        batch_job.error = str(e)
+        batch_job.status = "failed"
+    finally:
+        batch_job.finishedAt = datetime.utcnow().isoformat()
 
 # API Endpoints
 
@@ -358,47 +2569,270 @@ async def health_check():
 @app.post("/api/generate-plan", response_model=Dict[str, Any])
 async def generate_plan(
     request: GeneratePlanRequest,
-    client: anthropic.Anthropic = Depends(get_anthropic_client)
+    client: anthropic.AsyncAnthropic = Depends(get_anthropic_client)
 ):
     """Generate a complete marketing plan using Claude AI"""
     
     try:
         logger.info(f"Generating plan for {len(request.responses)} responses")
         
-        # Extract business context
-        business_context = extract_business_context(request.responses)
-        
-        # Generate content for all 9 squares
-        squares = {}
-        for square_id in range(1, 10):
-            logger.info(f"Generating content for square {square_id}")
-            square_content = await generate_square_content(request.responses, square_id, client)
-            squares[square_id] = square_content
-        
-        # Create the marketing plan
-        plan_id = str(uuid.uuid4())
-        plan = MarketingPlan(
-            businessContext=business_context,
-            squares=squares,
-            generatedAt=datetime.utcnow().isoformat(),
-            planId=plan_id
-        )
-        
-        # Store the plan
-        plans_storage[plan_id] = plan
-        
-        logger.info(f"Successfully generated plan {plan_id}")
+        # Serve resubmissions of the same questionnaire from the plan cache and attach
+        # to an identical generation that is already in flight, if any
+        plan, cached, coalesced = await get_or_create_plan(request, client)
+        missing = incomplete_squares(plan)
         
         return {
             "plan": plan.dict(),
-            "planId": plan_id,
-            "message": "Marketing plan generated successfully"
+            "planId": plan.planId,
+            "cached": cached,
+            "coalesced": coalesced,
+            "complete": not missing,
+            "message": (
+                f"Marketing plan generated without squares {missing}, fill them in with /api/plans/{plan.planId}/fill"
+                if missing else "Marketing plan generated successfully"
+            )
         }
         
+    except UpstreamOverloadedError as e:
+        logger.warning(f"Shedding plan generation: {e}")
+        raise overloaded_exception(e)
     except Exception as e:
         logger.error(f"Error generating plan: {e}")
         raise HTTPException(status_code=500, detail=f"Failed to generate marketing plan: {str(e)}")
 
+@app.post("/api/generate-plan/stream")
+async def generate_plan_stream(
+    request: GeneratePlanRequest,
+    tokens: bool = True,
+    client: anthropic.AsyncAnthropic = Depends(get_anthropic_client)
+):
+    """Generate a marketing plan, streaming each square as a Server-Sent Event as soon as it is ready.
+
+    With tokens=true (the default) an item event is also sent for every square field and
+    keyPoints/recommendations entry the moment it is complete. An item with field "retry"
+    means the square's upstream call is being retried and its earlier items are void.
+    With allowPartial a square that cannot be generated is reported with a square_failed
+    event and the plan completes without it.
+    """
+    
+    logger.info(f"Streaming plan for {len(request.responses)} responses")
+    try:
+        upstream_limiter.check_capacity(len(MARKETING_SQUARES))
+    except UpstreamOverloadedError as e:
+        logger.warning(f"Shedding streamed plan generation: {e}")
+        raise overloaded_exception(e)
+    business_context = extract_business_context(request.responses)
+    queue: asyncio.Queue = asyncio.Queue()
+
+    async def on_item(square_id: int, field: str, value: Any):
+        await queue.put(format_sse("item", {"squareId": square_id, "field": field, "value": value}))
+
+    async def produce():
+        usage = PlanUsage()
+        current_plan_usage.set(usage)
+        current_retry_budget.set(RetryBudget(PLAN_RETRY_BUDGET))
+        current_plan_admitted.set(True)
+        try:
+            fingerprint = questionnaire_fingerprint(request.responses)
+            plan = None if request.bypassCache else await get_cached_plan(fingerprint)
+            cached = plan is not None
+            if cached:
+                plan = store_cached_plan(plan)
+                for square_id, square in plan.squares.items():
+                    await queue.put(format_sse("square", {"squareId": square_id, "square": square.dict()}))
+            else:
+                squares = {}
+                upstream_limiter.admit(len(MARKETING_SQUARES))
+                try:
+                    async for square_id, square in iter_squares(
+                        request.responses, client, request.maxConcurrency, on_item if tokens else None,
+                        use_cache=not request.bypassCache, allow_partial=request.allowPartial
+                    ):
+                        if square is None:
+                            await queue.put(format_sse("square_failed", {"squareId": square_id}))
+                            continue
+                        squares[square_id] = square
+                        await queue.put(format_sse("square", {"squareId": square_id, "square": square.dict()}))
+                finally:
+                    upstream_limiter.release(len(MARKETING_SQUARES))
+                if not squares:
+                    raise HTTPException(status_code=500, detail="Failed to generate any marketing square")
+
+                plan = store_plan(
+                    business_context,
+                    {square_id: squares[square_id] for square_id in MARKETING_SQUARES if square_id in squares},
+                    usage,
+                    request.responses
+                )
+                if not incomplete_squares(plan):
+                    await cache_plan(fingerprint, plan)
+            logger.info(f"Successfully streamed plan {plan.planId}")
+            await queue.put(format_sse("complete", {
+                "planId": plan.planId,
+                "generatedAt": plan.generatedAt,
+                "usage": (plan.usage or usage).dict(),
+                "cached": cached,
+                "squareStatus": plan.squareStatus,
+                "message": "Marketing plan generated successfully"
+            }))
+        except UpstreamOverloadedError as e:
+            logger.warning(f"Shedding streamed plan generation: {e}")
+            await queue.put(format_sse("error", {
+                "message": "Marketing plan generation is at capacity, please retry later",
+                "retryAfter": e.retry_after
+            }))
+        except Exception as e:
+            logger.error(f"Error streaming plan: {e}")
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            await queue.put(format_sse("error", {"message": f"Failed to generate marketing plan: {detail}"}))
+        finally:
+            await queue.put(None)
+
+    async def event_stream() -> AsyncIterator[str]:
+        yield format_sse("context", business_context.dict())
+        producer = asyncio.create_task(produce())
+        try:
+            while (message := await queue.get()) is not None:
+                yield message
+        finally:
+            producer.cancel()
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@app.post("/api/generate-plan/bulk")
+async def generate_plans_bulk(
+    request: Request,
+    upload_format: Optional[Literal["jsonl", "csv"]] = Query(default=None, alias="format"),
+    client: anthropic.AsyncAnthropic = Depends(get_anthropic_client)
+):
+    """Generate a plan for every questionnaire in an uploaded JSONL or CSV body, streaming results as NDJSON.
+
+    The body (optionally gzip-compressed) is either one GeneratePlanRequest per line or a CSV
+    with a header row of questionIds; the format is taken from the Content-Type unless given.
+    Up to BULK_CONCURRENCY plans are generated at once and the upload is read only as fast
+    as they finish, so memory stays flat however many questionnaires are sent. Each result
+    line carries the line number of its record and arrives as soon as its plan is done.
+    """
+    upload_format = upload_format or ("csv" if "csv" in request.headers.get("content-type", "") else "jsonl")
+    logger.info(f"Bulk {upload_format} upload started")
+    
+    async def generate(line_number: int, record: Union[Dict[str, Any], str]) -> Dict[str, Any]:
+        if isinstance(record, str):
+            return {"line": line_number, "error": record}
+        try:
+            plan_request = GeneratePlanRequest(**record)
+        except (ValidationError, TypeError) as e:
+            return {"line": line_number, "error": f"Invalid request: {e}"}
+        try:
+            plan, cached = await wait_for_plan(plan_request, client, f"Bulk line {line_number}")
+        except Exception as e:
+            logger.error(f"Bulk line {line_number} failed: {e}")
+            detail = e.detail if isinstance(e, HTTPException) else str(e)
+            return {"line": line_number, "error": f"Failed to generate marketing plan: {detail}"}
+        return {
+            "line": line_number,
+            "planId": plan.planId,
+            "cached": cached,
+            "complete": not incomplete_squares(plan),
+            "plan": plan.dict()
+        }
+    
+    async def result_stream() -> AsyncIterator[str]:
+        pending: set = set()
+        records = 0
+        try:
+            async for line_number, record in iter_bulk_records(request.stream(), upload_format):
+                if len(pending) >= BULK_CONCURRENCY:
+                    done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                    for task in done:
+                        yield json.dumps(task.result()) + "\n"
+                pending.add(asyncio.create_task(generate(line_number, record)))
+                records += 1
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    yield json.dumps(task.result()) + "\n"
+            logger.info(f"Bulk upload finished, {records} records")
+        finally:
+            for task in pending:
+                task.cancel()
+    
+    return UploadStreamingResponse(result_stream(), media_type="application/x-ndjson")
+
+@app.post("/api/jobs", status_code=202, response_model=Dict[str, Any])
+async def create_job(
+    request: GeneratePlanRequest,
+    client: anthropic.AsyncAnthropic = Depends(get_anthropic_client)
+):
+    """Queue a marketing plan generation and return its job id immediately"""
+    prune_jobs()
+    job = Job(
+        jobId=str(uuid.uuid4()),
+        createdAt=datetime.utcnow().isoformat(),
+        squares={square_id: "pending" for square_id in MARKETING_SQUARES}
+    )
+    try:
+        job_queue.put_nowait((job, request, client))
+    except asyncio.QueueFull:
+        logger.warning("Job queue is full, rejecting job")
+        raise overloaded_exception(UpstreamOverloadedError(upstream_limiter.retry_after(len(MARKETING_SQUARES))))
+    jobs[job.jobId] = job
+    logger.info(f"Queued job {job.jobId} ({job_queue.qsize()} queued)")
+    
+    status_url = f"/api/jobs/{job.jobId}"
+    return JSONResponse(
+        status_code=202,
+        content={"jobId": job.jobId, "status": job.status, "statusUrl": status_url},
+        headers={"Location": status_url}
+    )
+
+@app.get("/api/jobs/{job_id}", response_model=Job)
+async def get_job(job_id: str):
+    """Get the status and per-square progress of a plan generation job"""
+    if job_id not in jobs:
+        raise HTTPException(status_code=404, detail="Job not found")
+    
+    return jobs[job_id]
+
+@app.post("/api/batches", status_code=202, response_model=Dict[str, Any])
+async def create_batch_job(
+    request: BatchPlanRequest,
+    client: anthropic.AsyncAnthropic = Depends(get_anthropic_client)
+):
+    """Generate many marketing plans offline through the Message Batches API"""
+    if not request.questionnaires:
+        raise HTTPException(status_code=400, detail="No questionnaires given")
+    
+    batch_job = BatchJob(
+        batchJobId=str(uuid.uuid4()),
+        createdAt=datetime.utcnow().isoformat(),
+        plans=len(request.questionnaires)
+    )
+    batch_jobs[batch_job.batchJobId] = batch_job
+    task = asyncio.create_task(run_batch_job(batch_job, request, client))
+    batch_tasks.add(task)
+    task.add_done_callback(batch_tasks.discard)
+    logger.info(f"Started batch job {batch_job.batchJobId} for {batch_job.plans} plans")
+    
+    status_url = f"/api/batches/{batch_job.batchJobId}"
+    return JSONResponse(
+        status_code=202,
+        content={"batchJobId": batch_job.batchJobId, "status": batch_job.status, "statusUrl": status_url},
+        headers={"Location": status_url}
+    )
+
+@app.get("/api/batches/{batch_job_id}", response_model=BatchJob)
+async def get_batch_job(batch_job_id: str):
+    """Get the status of a batch job and, once done, its plan ids"""
+    if batch_job_id not in batch_jobs:
+        raise HTTPException(status_code=404, detail="Batch job not found")
+    
+    return batch_jobs[batch_job_id]
+
 @app.get("/api/plans", response_model=List[PlanSummary])
 async def get_plans():
     """Get all saved marketing plans"""
@@ -441,6 +2875,149 @@ async def save_plan(request: SavePlanRequest):
         logger.error(f"Error saving plan: {e}")
         raise HTTPException(status_code=500, detail="Failed to save plan")
 
+@app.post("/api/plans/{plan_id}/squares/{square_id}/regenerate", response_model=Dict[str, Any])
+async def regenerate_square(
+    plan_id: str,
+    square_id: int,
+    client: anthropic.AsyncAnthropic = Depends(get_anthropic_client)
+):
+    """Generate fresh content for one square of a stored plan from its stored questionnaire"""
+    if plan_id not in plans_storage:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    if square_id not in MARKETING_SQUARES:
+        raise HTTPException(status_code=404, detail="Square not found")
+    plan = plans_storage[plan_id]
+    if plan.responses is None:
+        raise HTTPException(status_code=409, detail="Plan has no stored questionnaire to generate squares from")
+    
+    logger.info(f"Regenerating square {square_id} of plan {plan_id}")
+    usage = PlanUsage()
+    current_plan_usage.set(usage)
+    square_usage = PlanUsage()
+    current_square_usage.set(square_usage)
+    square_models: Set[str] = set()
+    current_square_models.set(square_models)
+    current_retry_budget.set(RetryBudget(PLAN_RETRY_BUDGET))
+    current_plan_admitted.set(True)
+    try:
+        upstream_limiter.admit(1)
+        try:
+            # Skips the square cache: the point is to get different content
+            square = await generate_square_content(plan.responses, square_id, client)
+        finally:
+            upstream_limiter.release(1)
+    except UpstreamOverloadedError as e:
+        logger.warning(f"Shedding square regeneration: {e}")
+        raise overloaded_exception(e)
+    await cache_square(plan.responses, square_id, square, square_usage, square_models)
+    
+    plan = await update_plan_squares(plan_id, plan, {square_id: square}, usage)
+    return {
+        "plan": plan.dict(),
+        "planId": plan_id,
+        "squareId": square_id,
+        "square": square.dict(),
+        "usage": usage.dict(),
+        "message": "Square regenerated successfully"
+    }
+
+@app.post("/api/plans/{plan_id}/update", response_model=Dict[str, Any])
+async def update_plan(
+    plan_id: str,
+    request: UpdatePlanRequest,
+    client: anthropic.AsyncAnthropic = Depends(get_anthropic_client)
+):
+    """Apply an edited questionnaire to a stored plan, regenerating only the squares whose answers changed.
+
+    A change to a business context field is read by every prompt and regenerates all 9 squares.
+    """
+    if plan_id not in plans_storage:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    plan = plans_storage[plan_id]
+    if plan.responses is None:
+        raise HTTPException(status_code=409, detail="Plan has no stored questionnaire to compare against")
+    
+    changed = changed_questions(plan.responses, request.responses)
+    affected = affected_squares(changed)
+    logger.info(f"Updating plan {plan_id}: questions {changed} changed, regenerating squares {affected}")
+    usage = PlanUsage()
+    current_plan_usage.set(usage)
+    current_retry_budget.set(RetryBudget(PLAN_RETRY_BUDGET))
+    current_plan_admitted.set(True)
+    generated: Dict[int, MarketingSquare] = {}
+    if affected:
+        try:
+            upstream_limiter.admit(len(affected))
+            try:
+                generated = await generate_all_squares(
+                    request.responses, client, request.maxConcurrency,
+                    square_ids=affected, allow_partial=request.allowPartial
+                )
+            finally:
+                upstream_limiter.release(len(affected))
+        except UpstreamOverloadedError as e:
+            logger.warning(f"Shedding plan update: {e}")
+            raise overloaded_exception(e)
+    
+    # Squares that failed to regenerate no longer match the questionnaire, so they are removed
+    failed = [square_id for square_id in affected if square_id not in generated]
+    plan = await update_plan_squares(
+        plan_id, plan, {**{square_id: None for square_id in failed}, **generated}, usage, request.responses
+    )
+    
+    return {
+        "plan": plan.dict(),
+        "planId": plan_id,
+        "changedQuestions": changed,
+        "regenerated": list(generated),
+        "failed": failed,
+        "usage": usage.dict(),
+        "message": "Plan updated successfully" if not failed else f"Squares {failed} could not be regenerated"
+    }
+
+@app.post("/api/plans/{plan_id}/fill", response_model=Dict[str, Any])
+async def fill_plan(
+    plan_id: str,
+    client: anthropic.AsyncAnthropic = Depends(get_anthropic_client)
+):
+    """Generate only the missing, failed or fallback squares of a stored plan"""
+    if plan_id not in plans_storage:
+        raise HTTPException(status_code=404, detail="Plan not found")
+    plan = plans_storage[plan_id]
+    if plan.responses is None:
+        raise HTTPException(status_code=409, detail="Plan has no stored questionnaire to generate squares from")
+    
+    missing = incomplete_squares(plan)
+    if not missing:
+        return {"plan": plan.dict(), "planId": plan_id, "filled": [], "failed": [], "message": "Plan is already complete"}
+    
+    logger.info(f"Filling squares {missing} of plan {plan_id}")
+    try:
+        upstream_limiter.admit(len(missing))
+    except UpstreamOverloadedError as e:
+        logger.warning(f"Shedding plan fill: {e}")
+        raise overloaded_exception(e)
+    usage = PlanUsage()
+    current_plan_usage.set(usage)
+    current_retry_budget.set(RetryBudget(PLAN_RETRY_BUDGET))
+    current_plan_admitted.set(True)
+    try:
+        generated = await generate_all_squares(plan.responses, client, square_ids=missing, allow_partial=True)
+    finally:
+        upstream_limiter.release(len(missing))
+    
+    plan = await update_plan_squares(plan_id, plan, generated, usage)
+    still_missing = incomplete_squares(plan)
+    logger.info(f"Filled squares {list(generated)} of plan {plan_id} with {usage.requests} calls")
+    return {
+        "plan": plan.dict(),
+        "planId": plan_id,
+        "filled": [square_id for square_id in generated if square_id not in still_missing],
+        "failed": still_missing,
+        "usage": usage.dict(),
+        "message": "Plan completed successfully" if not still_missing else f"Squares {still_missing} are still incomplete"
+    }
+
 @app.delete("/api/plans/{plan_id}", response_model=Dict[str, str])
 async def delete_plan(plan_id: str):
     """Delete a marketing plan"""
@@ -450,6 +3027,42 @@ async def delete_plan(plan_id: str):
     del plans_storage[plan_id]
     return {"message": "Plan deleted successfully"}
 
+@app.get("/api/metrics")
+async def get_metrics():
+    """Cache and generation metrics"""
+    return {
+        "upstream": upstream_limiter.stats(),
+        "rateLimits": rate_limiter.stats(),
+        "planCache": plan_cache.stats(),
+        "singleFlight": {**single_flight_stats, "inFlight": len(inflight_plans)},
+        "retries": retry_stats,
+        "structuredOutput": {
+            **structured_output_stats,
+            "wastedRate": structured_output_stats["wasted"] / max(1, structured_output_stats["responses"])
+        },
+        "streamValidation": stream_validation_stats,
+        "routes": {
+            route: {
+                **({"routing": SQUARE_ROUTES[int(route)]} if route.isdigit() else {}),
+                "models": {model: stats.stats(model) for model, stats in models.items()}
+            }
+            for route, models in route_stats.items()
+        },
+        "truncation": {**truncation_stats, "squares": output_lengths.stats()},
+        "hedging": hedge_policy.stats(),
+        "jobs": {
+            "workers": JOB_WORKERS,
+            "queued": job_queue.qsize(),
+            "running": sum(1 for job in jobs.values() if job.status == "running"),
+            "stored": len(jobs)
+        },
+        "diskCache": disk_cache.stats() if disk_cache is not None else None,
+        "squareCache": {
+            square_id: {**square_caches[square_id].stats(), "saved": square_cache_savings[square_id].dict()}
+            for square_id in MARKETING_SQUARES
+        }
+    }
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -0,0 +1,377 @@
+"""Offline benchmarks for plan generation using a simulated Claude client.
+
+Run with: python benchmark.py
+"""
+import asyncio
+import logging
+import os
+import random
+import time
+
+os.environ.setdefault("ANTHROPIC_API_KEY", "benchmark")
+# The event loop benchmark runs 450 simulated calls at once
+os.environ.setdefault("UPSTREAM_CONCURRENCY", "500")
+# The simulated client's latency does not depend on load, so the benchmarks use a fixed
+# limit; the adaptive limit is covered by tests/test_adaptive_concurrency.py
+os.environ.setdefault("ADAPTIVE_CONCURRENCY", "false")
+
+import app
+from tests.fakes import DETAILED_RESPONSES, SAMPLE_RESPONSES, FakeBatchServer, FakeClient
+
+logging.getLogger("app").setLevel(logging.WARNING)
+logging.getLogger("httpx").setLevel(logging.WARNING)
+
+
+async def bench_sequential(client) -> float:
+    start = time.perf_counter()
+    for square_id in app.MARKETING_SQUARES:
+        await app.generate_square_content(SAMPLE_RESPONSES, square_id, client)
+    return time.perf_counter() - start
+
+
+async def bench_concurrent(client, max_concurrency: int) -> float:
+    start = time.perf_counter()
+    await app.generate_all_squares(SAMPLE_RESPONSES, client, max_concurrency, use_cache=False)
+    return time.perf_counter() - start
+
+
+async def bench_fan_out():
+    random.seed(1)
+    print("== Square fan-out ==")
+    client = FakeClient()
+    elapsed = await bench_sequential(client)
+    print(f"sequential:        {elapsed:.2f}s (sum of squares {sum(client.messages.latencies):.2f}s)")
+    for max_concurrency in (3, 9):
+        client = FakeClient()
+        elapsed = await bench_concurrent(client, max_concurrency)
+        print(f"concurrency={max_concurrency}:     {elapsed:.2f}s (slowest square {max(client.messages.latencies):.2f}s)")
+
+
+async def bench_event_loop_lag():
+    """Measure how long a /health-style tick waits while plans generate"""
+    print("== Event loop responsiveness ==")
+    client = FakeClient()
+    lags = []
+
+    async def ticker():
+        while True:
+            start = time.perf_counter()
+            await asyncio.sleep(0.01)
+            lags.append(time.perf_counter() - start - 0.01)
+
+    tick_task = asyncio.create_task(ticker())
+    start = time.perf_counter()
+    await asyncio.gather(*(app.generate_all_squares(SAMPLE_RESPONSES, client, use_cache=False) for _ in range(50)))
+    elapsed = time.perf_counter() - start
+    tick_task.cancel()
+    print(f"50 concurrent plans: {elapsed:.2f}s, max loop lag {max(lags) * 1000:.1f}ms")
+
+
+async def bench_time_to_first_square():
+    random.seed(1)
+    print("== Streaming time-to-first-content ==")
+    client = FakeClient()
+    start = time.perf_counter()
+    first = None
+    async for _ in app.iter_squares(SAMPLE_RESPONSES, client, use_cache=False):
+        first = first or time.perf_counter() - start
+    elapsed = time.perf_counter() - start
+    print(f"first square: {first:.2f}s, full plan: {elapsed:.2f}s")
+
+    random.seed(1)
+    client = FakeClient()
+    start = time.perf_counter()
+    first_item = None
+
+    async def on_event(square_id, field, value):
+        nonlocal first_item
+        first_item = first_item or time.perf_counter() - start
+
+    async for _ in app.iter_squares(SAMPLE_RESPONSES, client, on_event=on_event, use_cache=False):
+        pass
+    print(f"token streaming first item: {first_item:.2f}s")
+
+
+async def bench_generation_modes():
+    print("== Per-square fan-out vs whole-plan ==")
+    for mode in ("per-square", "whole-plan"):
+        random.seed(1)
+        client = FakeClient()
+        start = time.perf_counter()
+        if mode == "whole-plan":
+            await app.generate_whole_plan(SAMPLE_RESPONSES, client)
+        else:
+            await app.generate_all_squares(SAMPLE_RESPONSES, client, use_cache=False)
+        elapsed = time.perf_counter() - start
+        usage = client.messages
+        print(
+            f"{mode:<11} calls={usage.calls} input_tokens={usage.input_tokens} "
+            f"output_tokens={usage.output_tokens} cost=${usage.cost():.4f} latency={elapsed:.2f}s"
+        )
+
+
+async def bench_prompt_cache():
+    print("== Prompt caching of the square system prompt ==")
+    # Two plans for different businesses; the second reads the prefix the first one wrote
+    for enabled in (False, True):
+        app.PROMPT_CACHE = enabled
+        random.seed(1)
+        client = FakeClient()
+        start = time.perf_counter()
+        for responses in (SAMPLE_RESPONSES, DETAILED_RESPONSES):
+            await app.generate_all_squares(responses, client, use_cache=False)
+        elapsed = time.perf_counter() - start
+        usage = client.messages
+        print(
+            f"cache={'on ' if enabled else 'off'} input={usage.input_tokens} "
+            f"cache_write={usage.cache_write_tokens} cache_read={usage.cache_read_tokens} "
+            f"cost=${usage.cost():.4f} latency={elapsed:.2f}s"
+        )
+    app.PROMPT_CACHE = True
+
+
+async def bench_square_cache():
+    print("== Per-square cache ==")
+    for cache in app.square_caches.values():
+        cache.entries.clear()
+    client = FakeClient((0.01, 0.02))
+    await app.generate_all_squares(SAMPLE_RESPONSES, client)
+    calls = client.messages.calls
+    edited = SAMPLE_RESPONSES + [app.QuestionnaireResponse(questionId="lead-magnets", answer="Free audit")]
+    await app.generate_all_squares(edited, client)
+    print(f"first questionnaire: {calls} calls, lead-magnets edit: {client.messages.calls - calls} calls")
+    saved = sum(savings.inputTokens + savings.outputTokens for savings in app.square_cache_savings.values())
+    print(f"tokens saved by square cache hits: {saved}")
+
+
+async def bench_rate_limit_pacing():
+    print("== Rate-limit pacing (simulated 600 requests/minute) ==")
+    random.seed(1)
+    client = FakeClient((0.05, 0.1), requests_per_minute=600)
+    # Peak traffic has nearly drained the bucket; the first response teaches the scheduler
+    # the limit and remaining budget, afterwards calls are paced instead of failing
+    client.messages.request_budget = 10
+    await app.generate_square_content(SAMPLE_RESPONSES, 1, client)
+    start = time.perf_counter()
+    await asyncio.gather(*(
+        app.generate_all_squares(SAMPLE_RESPONSES, client, use_cache=False) for _ in range(3)
+    ))
+    elapsed = time.perf_counter() - start
+    print(
+        f"27 calls in {elapsed:.2f}s, 429s={client.messages.rate_limited}, "
+        f"paced calls={app.rate_limiter.paced_calls}"
+    )
+
+
+async def bench_retries():
+    print("== Retries (simulated 20% of calls overloaded) ==")
+    random.seed(2)
+    app.RETRY_BASE_DELAY = 0.05
+    logging.getLogger("app").setLevel(logging.ERROR)
+    client = FakeClient((0.05, 0.1))
+    client.messages.failure_rate = 0.2
+    request = app.GeneratePlanRequest(responses=SAMPLE_RESPONSES, bypassCache=True)
+    completed = failed = 0
+    for _ in range(20):
+        try:
+            await app.create_plan(request, client, "retries")
+            completed += 1
+        except Exception:
+            failed += 1
+    logging.getLogger("app").setLevel(logging.WARNING)
+    print(f"plans completed={completed} failed={failed}, upstream failures={client.messages.failures}, {app.retry_stats}")
+
+
+async def bench_structured_output():
+    print("== Structured output (simulated 10% fenced, 3% truncated free-text responses) ==")
+    random.seed(5)
+    for structured in (False, True):
+        app.STRUCTURED_OUTPUT = structured
+        for key in app.structured_output_stats:
+            app.structured_output_stats[key] = 0
+        client = FakeClient((0.01, 0.02))
+        client.messages.fenced_rate = 0.1
+        client.messages.truncated_rate = 0.03
+        logging.getLogger("app").setLevel(logging.CRITICAL)
+        for _ in range(20):
+            await app.generate_all_squares(SAMPLE_RESPONSES, client, use_cache=False)
+        logging.getLogger("app").setLevel(logging.WARNING)
+        stats = app.structured_output_stats
+        print(
+            f"{'tool use ' if structured else 'free text'}: {stats['responses']} responses, "
+            f"repaired={stats['repaired']} wasted={stats['wasted']} ({stats['wasted'] / stats['responses']:.1%})"
+        )
+    app.STRUCTURED_OUTPUT = True
+
+
+async def bench_stream_validation():
+    print("== Early-abort stream validation (simulated 15% off-schema responses) ==")
+    for validate in (False, True):
+        random.seed(6)
+        app.STREAM_VALIDATION = validate
+        for key in app.structured_output_stats:
+            app.structured_output_stats[key] = 0
+        client = FakeClient((0.05, 0.1))
+        client.messages.off_schema_rate = 0.15
+        usage = app.PlanUsage()
+        app.current_plan_usage.set(usage)
+        app.current_retry_budget.set(None)
+        logging.getLogger("app").setLevel(logging.CRITICAL)
+        start = time.perf_counter()
+        for _ in range(10):
+            await app.generate_all_squares(SAMPLE_RESPONSES, client, use_cache=False)
+        elapsed = time.perf_counter() - start
+        logging.getLogger("app").setLevel(logging.WARNING)
+        app.current_plan_usage.set(None)
+        print(
+            f"validation={'on ' if validate else 'off'}: calls={usage.requests} output_tokens={usage.outputTokens} "
+            f"upstream calls={client.messages.calls} wasted={app.structured_output_stats['wasted']} time={elapsed:.2f}s"
+        )
+    print(f"aborted streams: {app.stream_validation_stats}")
+    app.STREAM_VALIDATION = True
+
+
+async def bench_max_tokens():
+    print("== Adaptive max_tokens and continuation (simulated 3% of squares 8x longer than usual) ==")
+    for adaptive, continuations in ((False, 0), (False, 2), (True, 2)):
+        random.seed(7)
+        app.ADAPTIVE_MAX_TOKENS = adaptive
+        app.MAX_CONTINUATIONS = continuations
+        app.output_lengths.samples.clear()
+        for stats in (app.structured_output_stats, app.truncation_stats):
+            for key in stats:
+                stats[key] = 0
+        client = FakeClient((0.01, 0.02))
+        client.messages.long_rate = 0.03
+        logging.getLogger("app").setLevel(logging.CRITICAL)
+        for _ in range(100):
+            await app.generate_all_squares(SAMPLE_RESPONSES, client, use_cache=False)
+        logging.getLogger("app").setLevel(logging.WARNING)
+        messages = client.messages
+        print(
+            f"max_tokens={'adaptive' if adaptive else 'fixed   '} continuations={continuations}: "
+            f"calls={messages.calls} reserved/call={messages.max_tokens / messages.calls:.0f} "
+            f"output/call={messages.output_tokens / messages.calls:.0f} "
+            f"truncated={app.truncation_stats['truncated']} wasted={app.structured_output_stats['wasted']}"
+        )
+    print(f"learned limits: {[limit['maxTokens'] for limit in app.output_lengths.stats().values()]}")
+    app.ADAPTIVE_MAX_TOKENS = True
+    app.MAX_CONTINUATIONS = 2
+    app.output_lengths.samples.clear()
+
+
+async def bench_model_routing():
+    print("== Per-square model routing (simulated fast model at 0.4x latency) ==")
+    random.seed(8)
+    # Forget the requests-per-minute limit learned by the pacing benchmark
+    app.rate_limiter = app.RateLimitScheduler()
+    client = FakeClient((0.2, 0.6))
+    client.messages.model_speed = {app.FAST_MODEL: 0.4}
+    routes = {square_id: dict(route) for square_id, route in app.SQUARE_ROUTES.items()}
+    for fast_squares in ([], [7, 8, 9]):
+        for square_id in fast_squares:
+            app.SQUARE_ROUTES[square_id]["model"] = app.FAST_MODEL
+        app.route_stats.clear()
+        start = time.perf_counter()
+        for _ in range(10):
+            await app.generate_all_squares(SAMPLE_RESPONSES, client, use_cache=False)
+        elapsed = time.perf_counter() - start
+        cost = sum(stats.cost(model) for models in app.route_stats.values() for model, stats in models.items())
+        slowest = max(
+            stats.stats(model)["latencySeconds"]["p95"]
+            for models in app.route_stats.values() for model, stats in models.items()
+        )
+        print(f"fast squares={fast_squares or 'none'}: 10 plans {elapsed:.2f}s, slowest route p95={slowest:.2f}s, cost=${cost:.4f}")
+    app.SQUARE_ROUTES.update(routes)
+
+    print("== Fallback model (simulated 30% of primary model calls overloaded) ==")
+    client.messages.failure_rate = 0.3
+    client.messages.failing_models = {app.STANDARD_MODEL}
+    app.RETRY_BASE_DELAY = 0.5
+    logging.getLogger("app").setLevel(logging.CRITICAL)
+    for fallback in (None, app.FAST_MODEL):
+        random.seed(9)
+        for route in app.SQUARE_ROUTES.values():
+            route["fallbackModel"] = fallback
+        app.route_stats.clear()
+        app.current_retry_budget.set(None)
+        start = time.perf_counter()
+        missing = 0
+        for _ in range(10):
+            squares = await app.generate_all_squares(SAMPLE_RESPONSES, client, use_cache=False, allow_partial=True)
+            missing += len(app.MARKETING_SQUARES) - len(squares)
+        elapsed = time.perf_counter() - start
+        fallbacks = sum(stats.fallbacks for models in app.route_stats.values() for stats in models.values())
+        print(f"fallback={fallback}: 10 plans {elapsed:.2f}s, squares missing={missing}, fallback calls={fallbacks}")
+    logging.getLogger("app").setLevel(logging.WARNING)
+    app.SQUARE_ROUTES.update(routes)
+
+
+async def bench_hedging():
+    print("== Hedged square requests (simulated 3% of calls 6x slower) ==")
+    for hedge in (False, True):
+        random.seed(10)
+        app.HEDGE_REQUESTS = hedge
+        app.hedge_policy = app.HedgePolicy(app.HEDGE_PERCENTILE, app.HEDGE_BUDGET, app.HEDGE_MIN_SAMPLES)
+        client = FakeClient((0.1, 0.2))
+        client.messages.slow_rate = 0.03
+        plan_latencies = []
+        for i in range(120):
+            start = time.perf_counter()
+            await app.generate_all_squares(SAMPLE_RESPONSES, client, use_cache=False)
+            # The first plans teach the hedge policy each square's latency
+            if i >= 20:
+                plan_latencies.append(time.perf_counter() - start)
+        plan_latencies.sort()
+        p50, p95 = plan_latencies[len(plan_latencies) // 2], plan_latencies[int(len(plan_latencies) * 0.95)]
+        print(
+            f"hedging={'on ' if hedge else 'off'}: plan p50={p50:.2f}s p95={p95:.2f}s max={plan_latencies[-1]:.2f}s "
+            f"upstream calls={client.messages.calls} hedges={app.hedge_policy.hedges} wins={app.hedge_policy.wins}"
+        )
+    app.HEDGE_REQUESTS = False
+
+
+async def bench_batch_mode():
+    print("== Message Batches bulk mode (local stand-in batch server) ==")
+    random.seed(4)
+    server = FakeBatchServer(error_rate=0.01)
+    questionnaires = [
+        [app.QuestionnaireResponse(questionId="business-industry", answer=f"Industry {i}")] + SAMPLE_RESPONSES[1:]
+        for i in range(50)
+    ]
+    admitted = app.upstream_limiter.admitted
+    logging.getLogger("app").setLevel(logging.CRITICAL)
+    start = time.perf_counter()
+    plans = await app.generate_plans_batch(questionnaires, server.client(), use_cache=False, poll_interval=0.01)
+    elapsed = time.perf_counter() - start
+    logging.getLogger("app").setLevel(logging.WARNING)
+    complete = sum(1 for plan in plans if not app.incomplete_squares(plan))
+    print(
+        f"{len(plans)} plans ({complete} complete) from {server.messages.calls} batch requests in "
+        f"{len(server.batches)} batch(es), {server.polls} polls, {elapsed:.2f}s"
+    )
+    print(
+        f"interactive calls used={app.upstream_limiter.admitted - admitted}, "
+        f"cost=${server.messages.cost() / 2:.4f} (interactive ${server.messages.cost():.4f})"
+    )
+
+
+async def main():
+    await bench_fan_out()
+    await bench_event_loop_lag()
+    await bench_time_to_first_square()
+    await bench_generation_modes()
+    await bench_prompt_cache()
+    await bench_square_cache()
+    await bench_rate_limit_pacing()
+    await bench_retries()
+    await bench_structured_output()
+    await bench_stream_validation()
+    await bench_max_tokens()
+    await bench_model_routing()
+    await bench_hedging()
+    await bench_batch_mode()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
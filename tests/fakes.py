@@ -0,0 +1,498 @@
+"""Simulated Claude clients and sample questionnaires shared by the tests and benchmark.py.
+
+FakeClient stands in for AsyncAnthropic in-process; FakeBatchServer serves the Message
+Batches API to the real SDK through httpx.MockTransport.
+"""
+import asyncio
+import json
+import random
+import time
+from types import SimpleNamespace
+from typing import Optional
+
+import anthropic
+import httpx
+
+import app
+
+
+SAMPLE_RESPONSES = [
+    app.QuestionnaireResponse(questionId="business-industry", answer="Software"),
+    app.QuestionnaireResponse(questionId="business-model", answer="B2B SaaS"),
+    app.QuestionnaireResponse(questionId="company-size", answer="11-50"),
+    app.QuestionnaireResponse(questionId="primary-challenges", answer=["Lead generation", "Retention"]),
+]
+
+# A questionnaire with long free-text answers, sharing only the square system prompt with SAMPLE_RESPONSES
+DETAILED_RESPONSES = SAMPLE_RESPONSES[:3] + [
+    app.QuestionnaireResponse(questionId="geographic-scope", answer="North America and the UK, expanding into the EU"),
+    app.QuestionnaireResponse(questionId="years-operation", answer="6"),
+    app.QuestionnaireResponse(questionId="marketing-budget", answer="$20,000-$50,000 per quarter"),
+    app.QuestionnaireResponse(questionId="primary-challenges", answer=[
+        "Inbound leads have plateaued since paid search costs doubled and organic traffic is flat",
+        "Trials convert well for teams under 20 seats but stall in procurement at larger accounts",
+        "Churn spikes after the first renewal when the original champion leaves the customer",
+        "Sales and marketing disagree on what counts as a qualified lead, so follow-up is slow",
+        "The product is hard to explain in one sentence and competitors undercut us on price",
+        "Case studies are out of date and mostly feature customers outside our current target market",
+        "The website has no clear path for evaluators from regulated industries such as finance and health",
+        "Our webinar programme draws signups but fewer than a fifth of registrants attend live",
+        "Partner referrals were our best channel but the partner programme has had no owner for a year",
+        "We have no reliable attribution, so budget decisions are made on gut feel and last-click data",
+        "Customer onboarding is run by one person and new accounts wait up to three weeks to go live",
+        "Our pricing page lists four plans with overlapping features and prospects ask sales to explain them"
+    ])
+]
+
+
+# Claude 3.5 Sonnet list prices, USD per million tokens
+INPUT_PRICE = 3.0
+OUTPUT_PRICE = 15.0
+CACHE_WRITE_PRICE = 3.75
+CACHE_READ_PRICE = 0.3
+
+# Shortest prefix each model caches; a cache_control breakpoint on a shorter one is ignored
+PROMPT_CACHE_MIN_TOKENS = {
+    "claude-3-5-sonnet-20241022": 1024,
+    "claude-3-5-haiku-20241022": 2048,
+    "claude-3-haiku-20240307": 2048
+}
+
+
+def estimate_tokens(text: str) -> int:
+    return max(1, len(text) // 4)
+
+
+class FakeMessages:
+    """Simulates messages.create; latency scales with the amount of output generated"""
+
+    def __init__(self, latency_range, requests_per_minute=None):
+        self.latency_range = latency_range
+        self.requests_per_minute = requests_per_minute
+        self.request_budget = float(requests_per_minute or 0)
+        self.budget_updated_at = time.monotonic()
+        self.rate_limited = 0
+        self.failure_rate = 0.0
+        self.failures = 0
+        # Models failure_rate applies to (all when None) and latency multipliers per model
+        self.failing_models = None
+        self.model_speed = {}
+        # Fraction of calls that stall, taking slow_factor times as long
+        self.slow_rate = 0.0
+        self.slow_factor = 6.0
+        # Fraction of free-text responses wrapped in a code fence and prose, and cut off mid-JSON
+        self.fenced_rate = 0.0
+        self.truncated_rate = 0.0
+        # Fraction of responses that go off-schema: a rambling unknown field or a wrong-typed value
+        self.off_schema_rate = 0.0
+        # Fraction of responses eight times longer than usual, which overrun a 1000 token max_tokens
+        self.long_rate = 0.0
+        # Full text of responses cut off at max_tokens, keyed on the output so far
+        self.unfinished = {}
+        self.max_tokens = 0
+        self.latencies = []
+        self.calls = 0
+        self.input_tokens = 0
+        self.output_tokens = 0
+        self.cache_write_tokens = 0
+        self.cache_read_tokens = 0
+        self.cached_prefixes = set()
+
+    def square_data(self, items: int = 5) -> dict:
+        return {
+            "title": "Simulated",
+            "summary": "Simulated summary of this marketing square for the business",
+            "keyPoints": [f"Key point {i} tailored to the business context and responses" for i in range(items)],
+            "recommendations": [f"Recommendation {i} with a concrete tactic and tool" for i in range(items)]
+        }
+
+    def response_text(self, prompt: str = "", tools=None) -> str:
+        if '"squares"' in prompt:
+            return json.dumps({"squares": {str(i): self.square_data() for i in app.MARKETING_SQUARES}})
+        square_data = self.square_data(40 if random.random() < self.long_rate else 5)
+        if random.random() < self.off_schema_rate:
+            if random.random() < 0.5:
+                square_data = {"analysis": "Let me think about this business in depth. " * 40, **square_data}
+            else:
+                square_data["keyPoints"] = " ".join(square_data["keyPoints"])
+        text = json.dumps(square_data)
+        if not tools:
+            roll = random.random()
+            if roll < self.truncated_rate:
+                text = text[:len(text) // 2]
+            elif roll < self.truncated_rate + self.fenced_rate:
+                text = f"Here is the square:\n```json\n{text}\n```\nLet me know if you need changes."
+        return text
+
+    def generate(self, kwargs) -> tuple:
+        """Output text and stop reason of a call, cut off after max_tokens of output.
+
+        A call whose last message is an assistant turn continues the response it prefills.
+        """
+        tools = kwargs.get("tools")
+        prefill = ""
+        if kwargs["messages"][-1]["role"] == "assistant":
+            prefill = kwargs["messages"][-1]["content"]
+            text = self.unfinished[prefill][len(prefill):]
+        else:
+            text = self.response_text(self.prompt_text(kwargs), tools)
+        self.max_tokens += kwargs["max_tokens"]
+        if estimate_tokens(text) <= kwargs["max_tokens"]:
+            return text, "tool_use" if tools else "end_turn"
+        cut = text[:kwargs["max_tokens"] * 4]
+        self.unfinished[(prefill + cut).rstrip()] = prefill + text
+        return cut, "max_tokens"
+
+    @staticmethod
+    def content(text: str, tools=None) -> list:
+        """Response content blocks: a tool call when tools were given, text otherwise"""
+        if tools:
+            try:
+                tool_input = json.loads(text)
+            except json.JSONDecodeError:
+                # Cut off mid-call
+                tool_input = {}
+            return [SimpleNamespace(type="tool_use", name=tools[0]["name"], input=tool_input)]
+        return [SimpleNamespace(type="text", text=text)]
+
+    @staticmethod
+    def prompt_text(kwargs) -> str:
+        content = kwargs["messages"][0]["content"]
+        if isinstance(content, str):
+            return content
+        return "".join(block["text"] for block in content)
+
+    def record(self, kwargs, text: str):
+        """Account for a call and return (latency, usage), simulating the prompt cache"""
+        prompt = self.prompt_text(kwargs)
+        squares = 9 if '"squares"' in prompt else 1
+        latency = sum(random.uniform(*self.latency_range) for _ in range(squares))
+        latency *= self.model_speed.get(kwargs["model"], 1.0)
+        if random.random() < self.slow_rate:
+            latency *= self.slow_factor
+        # Responses longer than a normal square (e.g. off-schema rambling) take proportionally longer
+        latency *= max(1.0, len(text) / (len(json.dumps(self.square_data())) * squares))
+        usage = SimpleNamespace(
+            input_tokens=0,
+            output_tokens=estimate_tokens(text),
+            cache_creation_input_tokens=0,
+            cache_read_input_tokens=0
+        )
+        content = kwargs["messages"][0]["content"]
+        # The cached prefix is the tools, system prompt and message blocks up to a cache_control
+        # breakpoint; the cache is per model and a breakpoint below the model's minimum is ignored
+        tools = json.dumps(kwargs["tools"]) if kwargs.get("tools") else ""
+        prefix_tokens = pending_tokens = estimate_tokens(tools) if tools else 0
+        prefix = [tools]
+        blocks = kwargs.get("system", []) + ([{"text": content}] if isinstance(content, str) else content)
+        for block in blocks:
+            tokens = estimate_tokens(block["text"])
+            prefix_tokens += tokens
+            pending_tokens += tokens
+            prefix.append(block["text"])
+            if "cache_control" not in block or prefix_tokens < PROMPT_CACHE_MIN_TOKENS.get(kwargs["model"], 1024):
+                continue
+            cache_key = (kwargs["model"], *prefix)
+            if cache_key in self.cached_prefixes:
+                usage.cache_read_input_tokens += pending_tokens
+            else:
+                usage.cache_creation_input_tokens += pending_tokens
+                self.cached_prefixes.add(cache_key)
+            pending_tokens = 0
+        usage.input_tokens += pending_tokens
+        # A continuation sends the output so far back as a prefilled assistant turn
+        for message in kwargs["messages"][1:]:
+            usage.input_tokens += estimate_tokens(message["content"])
+        self.latencies.append(latency)
+        self.calls += 1
+        self.input_tokens += usage.input_tokens
+        self.output_tokens += usage.output_tokens
+        self.cache_write_tokens += usage.cache_creation_input_tokens
+        self.cache_read_tokens += usage.cache_read_input_tokens
+        return latency, usage
+
+    def cost(self) -> float:
+        return (
+            self.input_tokens * INPUT_PRICE
+            + self.output_tokens * OUTPUT_PRICE
+            + self.cache_write_tokens * CACHE_WRITE_PRICE
+            + self.cache_read_tokens * CACHE_READ_PRICE
+        ) / 1_000_000
+
+    def check_rate_limit(self) -> dict:
+        """Simulate the server-side requests-per-minute bucket, returning rate-limit headers"""
+        if not self.requests_per_minute:
+            return {}
+        now = time.monotonic()
+        self.request_budget = min(
+            self.requests_per_minute,
+            self.request_budget + (now - self.budget_updated_at) * self.requests_per_minute / 60
+        )
+        self.budget_updated_at = now
+        headers = {"anthropic-ratelimit-requests-limit": str(self.requests_per_minute)}
+        if self.request_budget < 1:
+            self.rate_limited += 1
+            headers["anthropic-ratelimit-requests-remaining"] = "0"
+            headers["retry-after"] = str((1 - self.request_budget) * 60 / self.requests_per_minute)
+            response = httpx.Response(429, headers=headers, request=httpx.Request("POST", "https://api.anthropic.com"))
+            raise anthropic.RateLimitError("rate limited", response=response, body=None)
+        self.request_budget -= 1
+        headers["anthropic-ratelimit-requests-remaining"] = str(int(self.request_budget))
+        return headers
+
+    def check_overloaded(self, model: str):
+        """Fail a failure_rate fraction of calls to the failing models with a 529 overloaded error"""
+        if self.failing_models is not None and model not in self.failing_models:
+            return
+        if random.random() < self.failure_rate:
+            self.failures += 1
+            response = httpx.Response(529, request=httpx.Request("POST", "https://api.anthropic.com"))
+            raise anthropic.InternalServerError("overloaded", response=response, body=None)
+
+    async def create(self, **kwargs):
+        headers = self.check_rate_limit()
+        self.check_overloaded(kwargs["model"])
+        text, stop_reason = self.generate(kwargs)
+        latency, usage = self.record(kwargs, text)
+        await asyncio.sleep(latency)
+        return SimpleNamespace(
+            content=self.content(text, kwargs.get("tools")), model=kwargs["model"], usage=usage,
+            stop_reason=stop_reason, headers=headers
+        )
+
+    @property
+    def with_raw_response(self):
+        return FakeRawMessages(self)
+
+    def stream(self, **kwargs):
+        return FakeStream(self, kwargs)
+
+
+class FakeRawMessages:
+    """Simulates messages.with_raw_response"""
+
+    def __init__(self, messages: FakeMessages):
+        self.messages = messages
+
+    async def create(self, **kwargs):
+        message = await self.messages.create(**kwargs)
+        # Like the SDK's LegacyAPIResponse, whose parse() is synchronous
+        return SimpleNamespace(headers=message.headers, parse=lambda: message)
+
+
+class FakeStream:
+    """Simulates messages.stream, spreading the latency evenly over small text or tool JSON chunks"""
+
+    def __init__(self, messages: FakeMessages, kwargs: dict):
+        self.messages = messages
+        self.kwargs = kwargs
+
+    async def __aenter__(self):
+        self.response = SimpleNamespace(headers=self.messages.check_rate_limit())
+        self.messages.check_overloaded(self.kwargs["model"])
+        self.tools = self.kwargs.get("tools")
+        self.text, self.stop_reason = self.messages.generate(self.kwargs)
+        self.latency, self.usage = self.messages.record(self.kwargs, self.text)
+        return self
+
+    async def __aexit__(self, *exc):
+        return False
+
+    @property
+    def current_message_snapshot(self):
+        """Usage so far, with output tokens in proportion to the text streamed"""
+        usage = SimpleNamespace(**vars(self.usage))
+        usage.output_tokens = self.usage.output_tokens * self.streamed // max(1, len(self.text))
+        return SimpleNamespace(usage=usage)
+
+    async def __aiter__(self):
+        self.streamed = 0
+        chunks = [self.text[i:i + 8] for i in range(0, len(self.text), 8)]
+        for chunk in chunks:
+            await asyncio.sleep(self.latency / len(chunks))
+            self.streamed += len(chunk)
+            if self.tools:
+                yield SimpleNamespace(type="input_json", partial_json=chunk)
+            else:
+                yield SimpleNamespace(type="text", text=chunk)
+
+    async def get_final_message(self):
+        return SimpleNamespace(
+            content=FakeMessages.content(self.text, self.tools), model=self.kwargs["model"], usage=self.usage,
+            stop_reason=self.stop_reason
+        )
+
+
+class FakeClient:
+    def __init__(self, latency_range=(0.2, 0.6), requests_per_minute=None):
+        self.messages = FakeMessages(latency_range, requests_per_minute)
+
+
+def message_json(params: dict, text: str, stop_reason: str, usage: SimpleNamespace) -> dict:
+    """Messages API response body for a call: a tool call when tools were given, text otherwise"""
+    if params.get("tools"):
+        try:
+            tool_input = json.loads(text)
+        except json.JSONDecodeError:
+            # Cut off mid-call
+            tool_input = {}
+        content = [{"type": "tool_use", "id": "toolu_fake", "name": params["tools"][0]["name"], "input": tool_input}]
+    else:
+        content = [{"type": "text", "text": text}]
+    return {
+        "id": "msg_fake",
+        "type": "message",
+        "role": "assistant",
+        "model": params["model"],
+        "content": content,
+        "stop_reason": stop_reason,
+        "stop_sequence": None,
+        "usage": vars(usage)
+    }
+
+
+class FakeMessagesServer:
+    """Local stand-in for the Messages API, served to the real SDK through httpx.MockTransport.
+
+    Responses are generated by a FakeMessages simulator without its latency, and streamed
+    as server-sent events in small chunks when the request asks for a stream. Errors queued
+    on `errors` as (status, error type) are returned first, one per call; status 200 sends
+    the error as an event half way through a streamed response, as the API does when it
+    becomes overloaded mid-response.
+    """
+
+    def __init__(self):
+        self.messages = FakeMessages((0, 0))
+        self.requests = []
+        self.errors = []
+
+    def client(self) -> anthropic.AsyncAnthropic:
+        return anthropic.AsyncAnthropic(
+            api_key="test",
+            base_url="https://messages.test",
+            max_retries=0,
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+        )
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        params = json.loads(request.content)
+        self.requests.append(params)
+        status, error_type = self.errors.pop(0) if self.errors else (200, None)
+        error = {"type": "error", "error": {"type": error_type, "message": "simulated"}}
+        if status != 200:
+            return httpx.Response(status, json=error)
+        text, stop_reason = self.messages.generate(params)
+        _, usage = self.messages.record(params, text)
+        message = message_json(params, text, stop_reason, usage)
+        if not params.get("stream"):
+            return httpx.Response(200, json=message)
+        events = self.events(message, text, error if error_type else None)
+        return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=events)
+
+    @staticmethod
+    def events(message: dict, text: str, error: Optional[dict] = None) -> bytes:
+        """Server-sent events streaming a response's single content block in 8 character chunks.
+
+        With an error, the stream stops with an error event half way through the content.
+        """
+        block = message["content"][0]
+        if block["type"] == "tool_use":
+            start_block = {**block, "input": {}}
+            deltas = [{"type": "input_json_delta", "partial_json": text[i:i + 8]} for i in range(0, len(text), 8)]
+        else:
+            start_block = {"type": "text", "text": ""}
+            deltas = [{"type": "text_delta", "text": text[i:i + 8]} for i in range(0, len(text), 8)]
+        usage = message["usage"]
+        events = [
+            ("message_start", {"type": "message_start", "message": {
+                **message, "content": [], "stop_reason": None, "usage": {**usage, "output_tokens": 1}
+            }}),
+            ("content_block_start", {"type": "content_block_start", "index": 0, "content_block": start_block}),
+            *(("content_block_delta", {"type": "content_block_delta", "index": 0, "delta": delta}) for delta in deltas),
+            ("content_block_stop", {"type": "content_block_stop", "index": 0}),
+            ("message_delta", {
+                "type": "message_delta",
+                "delta": {"stop_reason": message["stop_reason"], "stop_sequence": None},
+                "usage": {"output_tokens": usage["output_tokens"]}
+            }),
+            ("message_stop", {"type": "message_stop"})
+        ]
+        if error is not None:
+            events = events[:2 + len(deltas) // 2] + [("error", error)]
+        return "".join(f"event: {name}\ndata: {json.dumps(data)}\n\n" for name, data in events).encode()
+
+
+class FakeBatchServer:
+    """Local stand-in for the Message Batches API, served to the real SDK through httpx.MockTransport.
+
+    A batch ends after polls_to_finish status polls; error_rate of its requests error.
+    """
+
+    def __init__(self, polls_to_finish: int = 3, error_rate: float = 0.0):
+        self.polls_to_finish = polls_to_finish
+        self.error_rate = error_rate
+        self.messages = FakeMessages((0, 0))
+        self.batches = {}
+        self.polls = 0
+
+    def client(self) -> anthropic.AsyncAnthropic:
+        return anthropic.AsyncAnthropic(
+            api_key="benchmark",
+            base_url="https://batches.test",
+            http_client=httpx.AsyncClient(transport=httpx.MockTransport(self.handle))
+        )
+
+    def batch_json(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        ended = batch["results"] is not None
+        count = len(batch["requests"])
+        errored = sum(1 for line in batch["results"] or [] if line["result"]["type"] == "errored")
+        return {
+            "id": batch_id,
+            "type": "message_batch",
+            "processing_status": "ended" if ended else "in_progress",
+            "request_counts": {
+                "processing": 0 if ended else count,
+                "succeeded": count - errored if ended else 0,
+                "errored": errored,
+                "canceled": 0,
+                "expired": 0
+            },
+            "created_at": "2024-01-01T00:00:00Z",
+            "expires_at": "2024-01-02T00:00:00Z",
+            "ended_at": "2024-01-01T01:00:00Z" if ended else None,
+            "archived_at": None,
+            "cancel_initiated_at": None,
+            "results_url": f"https://batches.test/v1/messages/batches/{batch_id}/results" if ended else None
+        }
+
+    def process(self, batch_id: str):
+        results = []
+        for request in self.batches[batch_id]["requests"]:
+            if random.random() < self.error_rate:
+                result = {"type": "errored", "error": {"type": "error", "error": {"type": "api_error", "message": "simulated"}}}
+            else:
+                tools = request["params"].get("tools")
+                text = self.messages.response_text(FakeMessages.prompt_text(request["params"]), tools)
+                _, usage = self.messages.record(request["params"], text)
+                result = {"type": "succeeded", "message": message_json(
+                    request["params"], text, "tool_use" if tools else "end_turn", usage
+                )}
+            results.append({"custom_id": request["custom_id"], "result": result})
+        self.batches[batch_id]["results"] = results
+
+    def handle(self, request: httpx.Request) -> httpx.Response:
+        path = request.url.path.rstrip("/").split("/")
+        if request.method == "POST" and path[-1] == "batches":
+            batch_id = f"msgbatch_{len(self.batches)}"
+            self.batches[batch_id] = {"requests": json.loads(request.content)["requests"], "polls": 0, "results": None}
+            return httpx.Response(200, json=self.batch_json(batch_id))
+        if path[-1] == "results":
+            lines = "\n".join(json.dumps(line) for line in self.batches[path[-2]]["results"])
+            return httpx.Response(200, content=lines.encode())
+        batch = self.batches[path[-1]]
+        self.polls += 1
+        batch["polls"] += 1
+        if batch["results"] is None and batch["polls"] >= self.polls_to_finish:
+            self.process(path[-1])
+        return httpx.Response(200, json=self.batch_json(path[-1]))
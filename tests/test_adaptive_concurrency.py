@@ -0,0 +1,60 @@
+"""AIMD concurrency limit against a simulated server, fed samples shaped like the
+ones AdmissionController.slot produces: latency per output token plus the raw
+wall-clock duration of the call."""
+import heapq
+import random
+
+import pytest
+
+import app
+
+
+def simulate(capacity: int, duration: float = 600.0, base_latency: float = 1.0, seed: int = 1):
+    """Discrete-event simulation of the limit with unbounded demand.
+
+    Call duration grows linearly once more than `capacity` calls are in flight and calls
+    fail as overloaded above 1.5x capacity. Returns (time, limit) samples.
+    """
+    rng = random.Random(seed)
+    limit = app.AdaptiveConcurrencyLimit(app.ADAPTIVE_INITIAL_CONCURRENCY, 1, 500)
+    completions = []
+    samples = []
+    now = 0.0
+    while now < duration:
+        while len(completions) < limit.current:
+            in_flight = len(completions) + 1
+            output_tokens = rng.randint(300, 900)
+            elapsed = base_latency * output_tokens / 600 * max(1.0, in_flight / capacity) * rng.uniform(0.9, 1.1)
+            heapq.heappush(completions, (now + elapsed, elapsed, output_tokens, in_flight > capacity * 1.5))
+        now, elapsed, output_tokens, overloaded = heapq.heappop(completions)
+        latency = None if overloaded else elapsed / max(output_tokens, 100)
+        limit.on_sample(latency, overloaded, now=now, duration=elapsed)
+        samples.append((now, limit.current))
+    return samples
+
+
+@pytest.mark.parametrize("capacity", [5, 40, 200])
+def test_limit_converges_to_capacity(capacity):
+    samples = simulate(capacity)
+    settled = [limit for t, limit in samples if t >= samples[-1][0] / 2]
+    mean = sum(settled) / len(settled)
+    assert 0.5 * capacity <= mean <= 1.5 * capacity
+    assert min(settled) >= max(1, capacity // 4)
+
+
+def test_spike_seen_by_many_calls_cuts_once():
+    limit = app.AdaptiveConcurrencyLimit(44, 1, 500)
+    # Warm up: one second calls of ~600 tokens
+    now = 0.0
+    for _ in range(200):
+        now += 1.0 / 44
+        limit.on_sample(1.0 / 600, now=now, duration=1.0)
+    limit.limit = 44.0
+    decreases = limit.decreases
+
+    # A one second 3x spike completes all 44 in-flight calls slowly
+    for i in range(44):
+        limit.on_sample(3.0 / 600, now=now + (i + 1) / 44, duration=3.0)
+
+    assert limit.decreases - decreases == 1
+    assert limit.current >= 22
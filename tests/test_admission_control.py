@@ -0,0 +1,39 @@
+"""Upstream admission: plans reserve their calls up front and are not shed halfway through."""
+import asyncio
+
+import pytest
+
+import app
+
+
+async def call(limiter: app.AdmissionController):
+    async with limiter.slot():
+        await asyncio.sleep(0.01)
+
+
+def test_unadmitted_call_is_shed_when_queue_is_full():
+    async def scenario():
+        limiter = app.AdmissionController(1, 0)
+        async with limiter.slot():
+            with pytest.raises(app.UpstreamOverloadedError):
+                await call(limiter)
+
+    asyncio.run(scenario())
+
+
+def test_admitted_plan_is_not_shed_after_limit_drops():
+    async def plan(limiter: app.AdmissionController):
+        limiter.admit(9)
+        app.current_plan_admitted.set(True)
+        try:
+            # The adaptive limit halves twice after the plan was admitted at 10
+            limiter.adaptive.limit = 2.0
+            await asyncio.gather(*(call(limiter) for _ in range(9)))
+        finally:
+            limiter.release(9)
+
+    limiter = app.AdmissionController(10, 2, app.AdaptiveConcurrencyLimit(10, 1, 10))
+    asyncio.run(plan(limiter))
+
+    assert limiter.rejected == 0
+    assert limiter.admitted == 9
@@ -0,0 +1,48 @@
+"""generate_plans_batch against the local stand-in for the Message Batches API."""
+import asyncio
+import random
+
+import app
+from tests.fakes import SAMPLE_RESPONSES, FakeBatchServer
+
+
+def questionnaires(count: int):
+    return [
+        [app.QuestionnaireResponse(questionId="business-industry", answer=f"Industry {i}")] + SAMPLE_RESPONSES[1:]
+        for i in range(count)
+    ]
+
+
+def errored_squares(server: FakeBatchServer):
+    """(questionnaire index, square id) of every batch request the server errored"""
+    errored = set()
+    for batch in server.batches.values():
+        for line in batch["results"]:
+            if line["result"]["type"] == "errored":
+                _, index, _, square_id = line["custom_id"].split("-")
+                errored.add((int(index), int(square_id)))
+    return errored
+
+
+def test_batch_generates_plans_without_interactive_calls():
+    random.seed(4)
+    server = FakeBatchServer(error_rate=0.1)
+    paths = []
+    handle = server.handle
+    server.handle = lambda request: paths.append(request.url.path) or handle(request)
+    admitted = app.upstream_limiter.admitted
+
+    plans = asyncio.run(app.generate_plans_batch(questionnaires(5), server.client(), use_cache=False, poll_interval=0.01))
+
+    assert len(plans) == 5
+    assert len(server.batches) == 1
+    assert sum(len(batch["requests"]) for batch in server.batches.values()) == 5 * len(app.MARKETING_SQUARES)
+    errored = errored_squares(server)
+    assert errored
+    for index, plan in enumerate(plans):
+        missing = {square_id for square_id in app.MARKETING_SQUARES if square_id not in plan.squares}
+        assert missing == {square_id for errored_index, square_id in errored if errored_index == index}
+        assert sorted(missing) == app.incomplete_squares(plan)
+        assert app.plans_storage[plan.planId] is plan
+    assert app.upstream_limiter.admitted == admitted
+    assert paths and all(path.startswith("/v1/messages/batches") for path in paths)
@@ -0,0 +1,144 @@
+"""Upstream calls made through the real SDK against the local stand-in for the Messages API."""
+import asyncio
+import json
+
+import anthropic
+import pytest
+from fastapi import HTTPException
+
+import app
+from tests.fakes import SAMPLE_RESPONSES, FakeMessagesServer
+
+
+def test_unstreamed_call_returns_parsed_message():
+    server = FakeMessagesServer()
+    usage = app.PlanUsage()
+    app.current_plan_usage.set(usage)
+
+    message = asyncio.run(app.create_message(server.client(), app.square_request_params(SAMPLE_RESPONSES, 1)))
+
+    assert message.stop_reason == "tool_use"
+    assert message.content[0].input["title"] == "Simulated"
+    assert usage.requests == 1
+    assert usage.outputTokens == message.usage.output_tokens
+    assert "stream" not in server.requests[0]
+
+
+def test_square_without_stream_validation(monkeypatch):
+    monkeypatch.setattr(app, "STREAM_VALIDATION", False)
+    server = FakeMessagesServer()
+
+    square = asyncio.run(app.generate_square_content(SAMPLE_RESPONSES, 1, server.client()))
+
+    assert square != app.fallback_square(1)
+    assert len(server.requests) == 1
+    assert "stream" not in server.requests[0]
+
+
+def test_whole_plan_in_one_call():
+    server = FakeMessagesServer()
+
+    squares = asyncio.run(app.generate_whole_plan(SAMPLE_RESPONSES, server.client()))
+
+    assert sorted(squares) == list(app.MARKETING_SQUARES)
+    assert len(server.requests) == 1
+
+
+def test_streamed_square_cut_off_is_continued(monkeypatch):
+    monkeypatch.setattr(app, "ADAPTIVE_MAX_TOKENS", False)
+    server = FakeMessagesServer()
+    # Eight times the usual length, which overruns SQUARE_MAX_TOKENS
+    server.messages.long_rate = 1.0
+    continuations = app.truncation_stats["continuations"]
+
+    square = asyncio.run(app.generate_square_content(SAMPLE_RESPONSES, 1, server.client()))
+
+    assert len(square.keyPoints) == 40
+    first, continuation = server.requests
+    assert first["stream"] and "tools" in first
+    assert "tools" not in continuation
+    assert continuation["messages"][-1]["role"] == "assistant"
+    assert continuation["messages"][-1]["content"].startswith('{"title"')
+    assert app.truncation_stats["continuations"] == continuations + 1
+
+
+def test_unstreamed_tool_call_cut_off_is_repeated(monkeypatch):
+    monkeypatch.setattr(app, "ADAPTIVE_MAX_TOKENS", False)
+    monkeypatch.setattr(app, "STREAM_VALIDATION", False)
+    server = FakeMessagesServer()
+    server.messages.long_rate = 1.0
+    repeated = app.truncation_stats["repeated"]
+
+    square = asyncio.run(app.generate_square_content(SAMPLE_RESPONSES, 1, server.client()))
+
+    assert len(square.keyPoints) == 40
+    first, repeat = server.requests
+    assert first["max_tokens"] == app.SQUARE_MAX_TOKENS
+    assert repeat["max_tokens"] == app.MAX_TOKENS_CEILING
+    assert "tools" in repeat
+    assert app.truncation_stats["repeated"] == repeated + 1
+
+
+@pytest.mark.parametrize("status", [529, 200])
+def test_overload_is_retried_on_the_fallback_model(monkeypatch, status):
+    limiter = app.AdmissionController(10, 10, app.AdaptiveConcurrencyLimit(10, 1, 10))
+    monkeypatch.setattr(app, "upstream_limiter", limiter)
+    server = FakeMessagesServer()
+    # Status 200: an overloaded_error event part-way through the streamed response
+    server.errors.append((status, "overloaded_error"))
+
+    square = asyncio.run(app.generate_square_content(SAMPLE_RESPONSES, 1, server.client()))
+
+    assert square != app.fallback_square(1)
+    assert len(square.keyPoints) == 5
+    first, retry = server.requests
+    assert retry["model"] == app.SQUARE_ROUTES[1]["fallbackModel"] != first["model"]
+    assert limiter.adaptive.decreases == 1
+
+
+def test_invalid_request_is_not_retried():
+    server = FakeMessagesServer()
+    server.errors.append((400, "invalid_request_error"))
+
+    with pytest.raises(HTTPException):
+        asyncio.run(app.generate_square_content(SAMPLE_RESPONSES, 1, server.client()))
+
+    assert len(server.requests) == 1
+
+
+def test_overload_retries_leave_the_schema_retries(monkeypatch):
+    monkeypatch.setattr(app, "RETRY_BASE_DELAY", 0.01)
+    server = FakeMessagesServer()
+    server.errors += [(529, "overloaded_error"), (529, "overloaded_error")]
+    response_text = server.messages.response_text
+    off_schema = [True]
+
+    def first_off_schema(prompt="", tools=None):
+        text = response_text(prompt, tools)
+        if off_schema:
+            off_schema.pop()
+            return json.dumps({"analysis": "Let me think about this business in depth.", **json.loads(text)})
+        return text
+
+    server.messages.response_text = first_off_schema
+    retries = app.stream_validation_stats["retries"]
+
+    square = asyncio.run(app.generate_square_content(SAMPLE_RESPONSES, 1, server.client()))
+
+    assert square != app.fallback_square(1)
+    assert len(server.requests) == 4
+    assert app.stream_validation_stats["retries"] == retries + 1
+
+
+def test_error_response_returns_its_output_reservation(monkeypatch):
+    limiter = app.RateLimitScheduler()
+    limiter.output_tokens.sync(6000, 3000)
+    monkeypatch.setattr(app, "rate_limiter", limiter)
+    server = FakeMessagesServer()
+    server.errors.append((529, "overloaded_error"))
+    available = limiter.output_tokens.tokens
+
+    with pytest.raises(anthropic.InternalServerError):
+        asyncio.run(app.create_message(server.client(), app.square_request_params(SAMPLE_RESPONSES, 1)))
+
+    assert limiter.output_tokens.tokens >= available
@@ -0,0 +1,26 @@
+"""Prompt caching of the square system prompt, against the local stand-in for the Messages API."""
+import asyncio
+
+import app
+from tests.fakes import DETAILED_RESPONSES, PROMPT_CACHE_MIN_TOKENS, SAMPLE_RESPONSES, FakeMessagesServer
+
+
+def test_square_prefix_is_cached_across_plans():
+    server = FakeMessagesServer()
+    client = server.client()
+
+    async def generate_plans():
+        first = await app.generate_all_squares(SAMPLE_RESPONSES, client, use_cache=False)
+        cache_write_tokens = server.messages.cache_write_tokens
+        second = await app.generate_all_squares(DETAILED_RESPONSES, client, use_cache=False)
+        return first, second, cache_write_tokens
+
+    first, second, cache_write_tokens = asyncio.run(generate_plans())
+
+    assert len(first) == len(second) == len(app.MARKETING_SQUARES)
+    assert all(request["system"][0]["cache_control"] == {"type": "ephemeral"} for request in server.requests)
+    # The tools and system prompt reach the standard model's minimum on their own
+    assert cache_write_tokens >= PROMPT_CACHE_MIN_TOKENS[app.STANDARD_MODEL]
+    # The second plan, for a different business, only reads the prefix the first one wrote
+    assert server.messages.cache_write_tokens == cache_write_tokens
+    assert server.messages.cache_read_tokens >= (len(server.requests) - 1) * cache_write_tokens